@@ -0,0 +1,89 @@
+import logging
+import random
+import time
+
+import click
+import numpy as np
+
+import moves_to_fen as mtf
+from move_encoding import encodeMoves
+from random_games import randomGames
+
+logging.basicConfig(level=logging.INFO,)
+
+LOGGER = logging.getLogger()
+
+
+def positionsViaFen(moves):
+    """the string based encoding: PgnToFen fens -> character array -> planes"""
+    fenList = mtf.movesToFenList(moves)
+    if fenList is None:
+        return None
+    return mtf.getFenPerChannel(mtf.fenList_to_fenArray(fenList))
+
+
+def positionsViaFenLut(moves):
+    """the fens of PgnToFen decoded with the byte lookup tables of fenListToPlanes"""
+    fenList = mtf.movesToFenList(moves)
+    if fenList is None:
+        return None
+    return mtf.fenListToPlanes(fenList)
+
+
+def attacksViaFen(moves):
+    """the string based attack planes, from the fens of the replayed game"""
+    fenList = mtf.movesToFenList(moves)
+    if fenList is None:
+        return None
+    return mtf.getAttacksTensorOverTime(fenList)
+
+
+def encodeWholeGame(moves):
+    return mtf.encodeGame(moves, 0, len(moves))
+
+
+def encodeIncremental(moves):
+    return mtf.encodeGame(moves, 0, len(moves), incremental_attacks=True)
+
+
+def timePerPly(games, encode):
+    num_plies = sum(len(moves) for moves in games)
+    start = time.perf_counter()
+    for moves in games:
+        encode(moves)
+    return (time.perf_counter() - start) / num_plies
+
+
+@click.command()
+@click.option("--num-games", default=100)
+@click.option("--num-plies", default=120, help="length of the random games in ply")
+@click.option("--seed", default=42)
+def main(num_games, num_plies, seed):
+    """compare the encoders of moves_to_fen on random games"""
+    rng = random.Random(seed)
+    games = randomGames(num_games, num_plies, rng)
+    # only games both encoders can replay
+    games = [moves for moves in games if mtf.movesToFenList(moves) is not None]
+    for moves in games:
+        positions, attacks = encodeWholeGame(moves)
+        assert np.array_equal(positionsViaFen(moves), positions)
+        assert np.array_equal(positionsViaFenLut(moves), positions)
+        assert np.array_equal(attacksViaFen(moves), attacks)
+        assert np.array_equal(encodeIncremental(moves)[1], attacks)
+    codes = [encodeMoves(moves) for moves in games]
+    LOGGER.info(f"{len(games)} games")
+    timings = {
+        "positions, fen strings": (games, positionsViaFen),
+        "positions, fen lookup table": (games, positionsViaFenLut),
+        "attacks, fen strings": (games, attacksViaFen),
+        "positions + attacks, bitboards": (games, encodeWholeGame),
+        "positions + attacks, codes": (codes, encodeWholeGame),
+        "incremental attacks, codes": (codes, encodeIncremental),
+        "replay only, codes": (codes, lambda moves: list(mtf.replayBoards(moves))),
+    }
+    for name, (inputs, encode) in timings.items():
+        LOGGER.info(f"{name:30s} {1e6 * timePerPly(inputs, encode):8.1f} us/ply")
+
+
+if __name__ == "__main__":
+    main()
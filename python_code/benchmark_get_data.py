@@ -0,0 +1,70 @@
+import io
+import logging
+import random
+import time
+
+import chess
+import chess.pgn
+import click
+
+import pgn_to_json
+
+logging.basicConfig(level=logging.INFO,)
+
+LOGGER = logging.getLogger()
+
+
+def randomGamePgn(num_plies, rng):
+    """pgn text of a game with (up to) num_plies random legal moves"""
+    board = chess.Board()
+    while len(board.move_stack) < num_plies and not board.is_game_over():
+        board.push(rng.choice(list(board.legal_moves)))
+    game = chess.pgn.Game.from_board(board)
+    return str(game) + "\n\n"
+
+
+def getMovesReplayFromRoot(game):
+    """the old extraction: node.board() replays the game from the root for every move"""
+    moves = []
+    node = game
+    while node.variations:
+        next_node = node.variation(0)
+        moves.append(node.board().san(next_node.move))
+        node = next_node
+    return moves
+
+
+def timePerPly(games, extract):
+    num_plies = sum(game.end().ply() for game in games)
+    start = time.perf_counter()
+    for game in games:
+        extract(game)
+    return (time.perf_counter() - start) / num_plies
+
+
+@click.command()
+@click.option("--num-games", default=50, help="games per game length")
+@click.option(
+    "--lengths", default="20,40,80,160,320", help="game lengths in ply, comma separated"
+)
+@click.option("--seed", default=42)
+def main(num_games, lengths, seed):
+    """compare the cost of extracting the moves of parsed games. Per ply, it should
+    stay flat with growing game length (linear per game) for the single board"""
+    rng = random.Random(seed)
+    LOGGER.info("plies | replay from root [us/ply] | single board SAN [us/ply] | UCI [us/ply]")
+    for num_plies in [int(length) for length in lengths.split(",")]:
+        pgn = io.StringIO("".join(randomGamePgn(num_plies, rng) for _ in range(num_games)))
+        games = list(iter(lambda: chess.pgn.read_game(pgn), None))
+        for game in games:
+            assert getMovesReplayFromRoot(game) == pgn_to_json.get_moves(game)
+        old = timePerPly(games, getMovesReplayFromRoot)
+        san = timePerPly(games, pgn_to_json.get_moves)
+        uci = timePerPly(games, lambda game: pgn_to_json.get_moves(game, uci=True))
+        LOGGER.info(
+            f"{num_plies:5d} | {1e6 * old:25.1f} | {1e6 * san:25.1f} | {1e6 * uci:12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
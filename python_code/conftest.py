@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture
+def array_paths(tmp_path):
+    """output paths of positions, labels and attacks for writeArrays"""
+    return [tmp_path / name for name in ("fen.npy", "labels.npy", "attacks.npy")]
@@ -0,0 +1,333 @@
+import hashlib
+import io
+import json
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# 0/1 planes of shape (..., 8, 8) are stored bit packed: every row of a board becomes
+# one byte, (..., 8) uint8, 8x smaller than uint8 planes and 64x smaller than int64
+
+
+def packPlanes(planes):
+    """pack 0/1 planes of shape (..., 8, 8) into uint8 rows of shape (..., 8)"""
+    return np.packbits(np.asarray(planes, dtype=np.uint8), axis=-1)[..., 0]
+
+
+def unpackPlanes(packed, dtype=np.float32):
+    """inverse of packPlanes, returns 0/1 planes of shape (..., 8, 8) as dtype"""
+    return np.unpackbits(packed[..., np.newaxis], axis=-1).astype(dtype, copy=False)
+
+
+class ArrayWriter:
+    """writes samples one at a time into a .npy file preallocated for max_samples
+    samples and memory mapped, so only the current sample has to be in memory. If
+    fewer samples are written, close shrinks the file to the samples written"""
+
+    def __init__(self, path, max_samples, sample_shape, dtype):
+        self.path = path
+        self.array = np.lib.format.open_memmap(
+            path, mode="w+", dtype=dtype, shape=(max_samples,) + tuple(sample_shape)
+        )
+        self.count = 0
+
+    def append(self, sample):
+        self.array[self.count] = sample
+        self.count += 1
+
+    def extend(self, samples):
+        self.array[self.count : self.count + len(samples)] = samples
+        self.count += len(samples)
+
+    def close(self):
+        """flush the samples to disk, returns their count"""
+        max_samples = len(self.array)
+        sample_shape = self.array.shape[1:]
+        header = {
+            "descr": np.lib.format.dtype_to_descr(self.array.dtype),
+            "fortran_order": False,
+            "shape": (self.count,) + sample_shape,
+        }
+        sample_size = self.array.itemsize * int(np.prod(sample_shape))
+        data_offset = self.array.offset
+        self.array.flush()
+        self.array = None  # unmap before resizing the file
+        if self.count < max_samples:
+            # numpy pads the header with spaces up to a multiple of 64 bytes, a shape
+            # with fewer digits usually fits in the same padded size, so the header is
+            # rewritten in place and the data does not have to move
+            buffer = io.BytesIO()
+            np.lib.format.write_array_header_1_0(buffer, header)
+            if buffer.tell() != data_offset:
+                raise ValueError(f"can not shrink the header of {self.path} in place")
+            with open(self.path, "r+b") as f:
+                f.write(buffer.getvalue())
+                f.truncate(data_offset + self.count * sample_size)
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.array is not None:
+            self.close()
+
+
+def loadPacked(path):
+    """the bit packed planes of a file written with ArrayWriter, memory mapped. Files
+    written before the planes were packed (unpacked planes in arr_0 of a .npz) are
+    packed on load"""
+    data = np.load(path, mmap_mode="r")
+    if isinstance(data, np.ndarray):
+        return data
+    with data:
+        return packPlanes(data["arr_0"])
+
+
+def loadLabels(path):
+    """the labels of a .npy file written with ArrayWriter (or arr_0 of an older .npz)"""
+    data = np.load(path)
+    if isinstance(data, np.ndarray):
+        return data
+    with data:
+        return data["arr_0"]
+
+
+SHARD_ARRAYS = ("positions", "attacks", "labels")
+
+
+def fileChecksum(path):
+    sha256 = hashlib.sha256()
+    with open(str(path), "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def writeShard(path, positions, attacks, labels):
+    """write the (bit packed) positions, attacks and labels of a shard to an
+    uncompressed .npz, returns its manifest entry without the game range"""
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(str(tmp_path), "wb") as f:  # savez appends .npz to a path, not to a file
+        np.savez(f, positions=positions, attacks=attacks, labels=labels)
+    os.replace(str(tmp_path), str(path))
+    return {
+        "file": path.name,
+        "count": len(labels),
+        "size": path.stat().st_size,
+        "sha256": fileChecksum(path),
+    }
+
+
+def readShard(path, sha256=None):
+    """positions, attacks and labels of a shard, checked against sha256 if given"""
+    if sha256 is not None and fileChecksum(path) != sha256:
+        raise ValueError(f"checksum of {path} does not match the manifest")
+    with np.load(str(path)) as data:
+        return tuple(data[name] for name in SHARD_ARRAYS)
+
+
+class ShardedDataset:
+    """an encoded data set split into shards of shard_size input games, each an .npz
+    with positions, attacks and labels, plus a JSON manifest with the shapes and
+    dtypes of the arrays, the sample counts and the checksum of every shard. Shards
+    are written and read independently; every shard records a key of its input
+    games and encoding options, so a rerun only rewrites the shards whose key
+    changed. The manifest is saved after every shard written, an interrupted run
+    keeps the shards it finished"""
+
+    file_name = "dataset_manifest.json"
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        manifest_path = self.path / self.file_name
+        self.manifest = {"arrays": {}, "shards": []}
+        if manifest_path.exists():
+            with open(str(manifest_path)) as f:
+                self.manifest = json.load(f)
+
+    @property
+    def shards(self):
+        return self.manifest["shards"]
+
+    def __len__(self):
+        return sum(shard.get("count", 0) for shard in self.shards)
+
+    def shardPath(self, index):
+        return self.path / f"shard-{index:05d}.npz"
+
+    def isCurrent(self, index, key, verify=False):
+        """whether shard index was written with this input key and its file has the
+        size in the manifest (and, if verify, its checksum)"""
+        if index >= len(self.shards):
+            return False
+        shard = self.shards[index]
+        if shard["key"] != key or "file" not in shard:
+            return False
+        path = self.path / shard["file"]
+        if not path.exists() or path.stat().st_size != shard.get("size"):
+            return False
+        return not verify or fileChecksum(path) == shard["sha256"]
+
+    def save(self, shards, arrays, remove_stale=True):
+        """write the manifest for shards (entries of writeShard plus games and key,
+        only games and key for shards not written yet), replacing the old one
+        atomically. If remove_stale, shard files that are not part of the data set
+        any more are removed"""
+        self.manifest = {
+            "arrays": arrays,
+            "count": sum(shard.get("count", 0) for shard in shards),
+            "complete": all("file" in shard for shard in shards),
+            "shards": shards,
+        }
+        tmp_path = self.path / (self.file_name + ".tmp")
+        with open(str(tmp_path), "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(str(tmp_path), str(self.path / self.file_name))
+        if remove_stale:
+            files = {shard.get("file") for shard in shards}
+            for path in self.path.glob("shard-*.npz"):
+                if path.name not in files:
+                    path.unlink()
+
+    def readShard(self, index, verify=True):
+        shard = self.shards[index]
+        return readShard(self.path / shard["file"], shard["sha256"] if verify else None)
+
+    def load(self, workers=4, verify=True):
+        """positions, attacks and labels of all shards, read in parallel threads"""
+        if not self.manifest.get("complete", True):
+            raise ValueError(f"{self.path} is incomplete, rerun writeShards")
+        with ThreadPoolExecutor(workers) as executor:
+            parts = list(
+                executor.map(
+                    lambda index: self.readShard(index, verify), range(len(self.shards))
+                )
+            )
+        arrays = []
+        for k, name in enumerate(SHARD_ARRAYS):
+            info = self.manifest["arrays"][name]
+            empty = np.empty([0] + info["shape"], dtype=info["dtype"])
+            arrays.append(np.concatenate([empty] + [part[k] for part in parts]))
+        return tuple(arrays)
+
+
+class GameStore:
+    """every ply of every game (up to a maximal game length) encoded once: positions
+    and attacks of all plies of all games bit packed in ply order, (plies, 12, 8),
+    offsets[g] the first ply of game g (offsets[-1] the number of plies) and the
+    labels of the games, each a .npy file in path. Ply windows are chosen when the
+    store is read (see window), not when it is encoded"""
+
+    file_names = {
+        "positions": "positions.npy",
+        "attacks": "attacks.npy",
+        "offsets": "offsets.npy",
+        "labels": "labels.npy",
+    }
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.positions = np.load(str(self.path / self.file_names["positions"]), "r")
+        self.attacks = np.load(str(self.path / self.file_names["attacks"]), "r")
+        self.offsets = np.load(str(self.path / self.file_names["offsets"]))
+        self.labels = np.load(str(self.path / self.file_names["labels"]))
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def window(self, min_ply=0, max_ply=None, last_plies=None):
+        """indices (games, time) into positions and attacks of the plies min_ply to
+        max_ply, or of the last last_plies plies, of every game that has them, and the
+        labels of these games. positions[indices] are the samples of the window"""
+        if last_plies is not None:
+            games = np.flatnonzero(self.lengths >= last_plies)
+            first = self.offsets[games + 1] - last_plies
+            num_plies = last_plies
+        else:
+            if max_ply is None:
+                raise ValueError("need max_ply or last_plies")
+            games = np.flatnonzero(self.lengths >= max_ply)
+            first = self.offsets[games] + min_ply
+            num_plies = max_ply - min_ply
+        indices = first[:, np.newaxis] + np.arange(num_plies)
+        return indices, self.labels[games]
+
+
+class GameStoreWriter:
+    """writes the games of a GameStore one at a time, positions and attacks into
+    files preallocated for max_plies plies"""
+
+    def __init__(self, path, max_plies):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        names = GameStore.file_names
+        self.positions = ArrayWriter(
+            str(self.path / names["positions"]), max_plies, (12, 8), np.uint8
+        )
+        self.attacks = ArrayWriter(
+            str(self.path / names["attacks"]), max_plies, (12, 8), np.uint8
+        )
+        self.offsets = [0]
+        self.labels = []
+
+    def append(self, positions, attacks, label):
+        """add a game, positions and attacks bit packed, (plies, 12, 8)"""
+        self.positions.extend(positions)
+        self.attacks.extend(attacks)
+        self.offsets.append(self.positions.count)
+        self.labels.append(label)
+
+    def close(self):
+        """returns the number of games written"""
+        self.positions.close()
+        self.attacks.close()
+        names = GameStore.file_names
+        np.save(str(self.path / names["offsets"]), np.array(self.offsets, np.int64))
+        np.save(str(self.path / names["labels"]), np.array(self.labels, np.int64))
+        return len(self.labels)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.positions.array is not None:
+            self.close()
+
+
+def loadTrainingData(
+    input_path,
+    input_path_attacks,
+    input_path_labels,
+    input_dir,
+    store_dir=None,
+    min_ply=0,
+    max_ply=None,
+    last_plies=None,
+):
+    """bit packed positions and attacks, the indices of the samples into them and
+    the labels of the samples; positions[indices[i]] is sample i. From a GameStore in
+    store_dir with the ply window min_ply to max_ply or the last last_plies plies, a
+    ShardedDataset in input_dir, or the three array files"""
+    if store_dir:
+        store = GameStore(store_dir)
+        indices, labels = store.window(min_ply, max_ply, last_plies)
+        return store.positions, store.attacks, indices, labels
+    if input_dir:
+        positions, attacks, labels = ShardedDataset(input_dir).load()
+    elif input_path and input_path_attacks and input_path_labels:
+        positions = loadPacked(input_path)
+        attacks = loadPacked(input_path_attacks)
+        labels = loadLabels(input_path_labels)
+    else:
+        raise ValueError(
+            "need a game store, a sharded data set or all three input arrays"
+        )
+    return positions, attacks, np.arange(len(labels)), labels
@@ -0,0 +1,28 @@
+# the filters of preprocess.prefilterGames on the headers of a single game, in a module
+# without side effects on import, so pgn_to_json can apply them while parsing
+
+LOST_RESULT = {"White": "0-1", "Black": "1-0"}  # result of games the color lost
+OPPONENT = {"White": "Black", "Black": "White"}
+
+
+def headersPassPrefilter(headers, params, human_color=None):
+    """the row filters of prefilterGames for the headers of a single game, so games
+    can be discarded during ingestion before their moves are parsed. Without
+    human_color, games that pass for either color are kept"""
+    try:
+        ply_count = int(headers.get("PlyCount"))
+    except (TypeError, ValueError):
+        return False
+    if not params["plymax"] < ply_count < params["max_game_length"]:
+        return False
+    if headers.get("TimeControl") not in params["timecontrols"]:
+        return False
+    colors = [human_color] if human_color else ["White", "Black"]
+    for color in colors:
+        if (
+            headers.get(color + "IsComp") is None  # the human
+            and headers.get("Result") == LOST_RESULT[color]
+            and headers.get(OPPONENT[color] + "IsComp") in (None, "Yes")
+        ):
+            return True
+    return False
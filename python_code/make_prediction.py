@@ -4,7 +4,10 @@ import numpy as np
 import tensorflow as tf
 import h5py
 import json
-import pandas as pd
+from dataset_io import GameStore, loadPacked, unpackPlanes
+from moves_to_fen import encodeGame
+from position_cache import PositionCache
+from preprocess import readGames
 
 
 logging.basicConfig(level=logging.INFO,)
@@ -46,13 +49,13 @@ def checkParameters(df, human_color, params):
     "--input-path-attacks",
     help="input array of training data (attacked squares)",
     required=True,
-    default="data/preprocessed/fen_eval_attacks.npy.npz",
+    default="data/preprocessed/fen_eval_attacks.npy",
 )
 @click.option(
     "--input-path",
     help="input array of training data (positions)",
     required=True,
-    default="data/preprocessed/fen_eval.npy.npz",
+    default="data/preprocessed/fen_eval.npy",
 )
 @click.option(
     "--input-path-model-black",
@@ -72,6 +75,20 @@ def checkParameters(df, human_color, params):
 @click.option(
     "--path-json-data", required=True, default="data/raw_data/json/evaluation/eval.json"
 )
+@click.option(
+    "--cache-path",
+    help="encode the game directly, with this position cache file (sqlite), instead "
+    "of loading the arrays of the input paths",
+)
+@click.option(
+    "--store-dir",
+    help="take the plies plymin to plymax of the game from this game store instead",
+)
+@click.option(
+    "--last-plies",
+    type=int,
+    help="with --store-dir, use the last plies of the game instead of plymin to plymax",
+)
 @click.option(
     "--human-player-color",
     help="Black or White, what did the human play",
@@ -85,15 +102,35 @@ def main(
     input_path_model_white,
     human_player_color,
     params_path,
+    cache_path,
+    store_dir,
+    last_plies,
 ):
     with open(params_path) as f:
         params = json.load(f)
-    df = pd.read_json(path_json_data)
+    df = readGames(path_json_data)
     checkParameters(df, human_player_color, params)
 
-    data_positions = np.load(input_path)["arr_0"]
-    data_attacks = np.load(input_path_attacks)["arr_0"]
-    data = np.concatenate((data_positions, data_attacks), axis=2)
+    if cache_path:
+        cache = PositionCache(path=cache_path)
+        encoded = encodeGame(df.moves[0], params["plymin"], params["plymax"], cache)
+        LOGGER.info(f"position cache: {cache.stats()}")
+        cache.close()
+        if encoded is None:
+            raise ValueError("can not replay the moves of the game")
+        data_positions, data_attacks = encoded
+        data = np.concatenate((data_positions, data_attacks), axis=1)[np.newaxis]
+        data = data.astype(np.float32)
+    elif store_dir:
+        store = GameStore(store_dir)
+        indices, _ = store.window(params["plymin"], params["plymax"], last_plies)
+        data_positions = unpackPlanes(store.positions[indices])
+        data_attacks = unpackPlanes(store.attacks[indices])
+        data = np.concatenate((data_positions, data_attacks), axis=2)
+    else:
+        data_positions = unpackPlanes(loadPacked(input_path))
+        data_attacks = unpackPlanes(loadPacked(input_path_attacks))
+        data = np.concatenate((data_positions, data_attacks), axis=2)
     if human_player_color == "White":
         opponent = "Black"
         model_path = input_path_model_white
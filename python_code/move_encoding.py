@@ -0,0 +1,34 @@
+import chess
+import numpy as np
+
+# a move packed into 16 bits: from-square in bits 0-5, to-square in bits 6-11 and
+# the promotion piece type (0 = none, 2-5 = knight-queen) in bits 12-14
+MOVE_DTYPE = np.int16
+
+
+def encodeMove(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decodeMove(code):
+    code = int(code)
+    return chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None)
+
+
+def encodeMoves(moves):
+    """turn a game's moves (SAN or UCI strings) into an int16 array, replaying them on a
+    board to resolve the SAN. Returns None if a move can not be parsed"""
+    board = chess.Board()
+    codes = np.empty(len(moves), dtype=MOVE_DTYPE)
+    try:
+        for i, san in enumerate(moves):
+            move = board.parse_san(str(san))
+            codes[i] = encodeMove(move)
+            board.push(move)
+    except ValueError:
+        return None
+    return codes
+
+
+def decodeMoves(codes):
+    return [decodeMove(code) for code in codes]
@@ -1,3 +1,4 @@
+import collections
 import pandas as pd
 import click
 import logging
@@ -5,7 +6,27 @@ import numpy as np
 import pgn_to_fen
 import chess
 from tqdm import tqdm
+import hashlib
 import json
+import multiprocessing
+import pathlib
+import struct
+import pyarrow.parquet
+from move_encoding import MOVE_DTYPE, decodeMove
+from dataset_io import (
+    ArrayWriter,
+    GameStoreWriter,
+    ShardedDataset,
+    packPlanes,
+    writeShard,
+)
+from position_cache import (
+    GameCache,
+    getGameCache,
+    getPositionCache,
+    updateZobristHash,
+    zobristHash,
+)
 
 logging.basicConfig(level=logging.INFO,)
 
@@ -30,21 +51,51 @@ def getFenArray(fen):
     return fenArray
 
 
-def movesToFenList(movesList):
-    """given a list of moves, return a list of standard fen notations"""
+def movesToFenList(movesList, min_ply=0, max_ply=None):
+    """given a list of moves, return a list of standard fen notations of the plies
+    min_ply to max_ply (all by default); moves after max_ply are not replayed"""
     fenlist = []
     pgnConverter = pgn_to_fen.PgnToFen()
     pgnConverter.resetBoard()
     try:
-        for move in movesList:
+        for ply, move in enumerate(movesList[:max_ply]):
             pgnConverter.move(str(move))
-            fen = pgnConverter.getFullFen()
-            fenlist.append(fen.split(" ")[0])
+            if ply >= min_ply:
+                fen = pgnConverter.getFullFen()
+                fenlist.append(fen.split(" ")[0])
         return fenlist
     except Exception:
         LOGGER.info("can not create fen")
 
 
+def encodedMoveLists(column):
+    """zero-copy int16 views on the moves of each game of an arrow list<int16> column
+    (None for games that could not be encoded)"""
+    moves = []
+    for chunk in column.chunks:
+        values = chunk.values.to_numpy()
+        offsets = chunk.offsets.to_numpy()
+        valid = chunk.is_valid().to_numpy(zero_copy_only=False)
+        moves.extend(
+            values[offsets[i] : offsets[i + 1]] if valid[i] else None
+            for i in range(len(chunk))
+        )
+    return moves
+
+
+def loadGames(input_path):
+    """moves and labels of the preprocessed games; if the parquet file has the
+    moves_encoded column, the moves are int16 arrays instead of lists of SAN strings"""
+    table = pyarrow.parquet.read_table(input_path)
+    if "moves_encoded" in table.column_names:
+        moves = encodedMoveLists(table.column("moves_encoded"))
+    else:
+        moves = table.column("moves").to_pylist()
+    return pd.DataFrame(
+        {"moves": moves, "opponentIsComp": table.column("opponentIsComp").to_numpy()}
+    )
+
+
 def fenList_to_fenArray(fenList):
     """turn standard fen notation into a fen version with zeros for empty squares 
     (e.g. "00000000" instead of "8" for eight free squares)"""
@@ -122,30 +173,666 @@ def getFenPerChannel(input_array):
     return res.astype(int)
 
 
-def getArrayLists(df, min_ply, max_ply):
-    resList = []
-    labelList = []
-    attacksList = []
-    for moveList, label in tqdm(zip(df["moves"], df["opponentIsComp"])):
-        # loop over games, TODO: optimize
-        fenList = movesToFenList(moveList)
-        failCounter = 0
-        if not fenList:
+# lookup tables over the bytes of a fen: FEN_WIDTHS is the number of squares a
+# character covers (1 for a piece, n for the digit n, 0 for the rank separator),
+# FEN_CODES the piece index of a square, 0 for empty and k + 1 for channel k of
+# getFenPerChannel. Bytes that can not appear in a piece placement cover no square
+FEN_WIDTHS = np.zeros(256, dtype=np.int64)
+FEN_CODES = np.zeros(256, dtype=np.uint8)
+for k, piece in enumerate("PRNBQKprnbqk"):
+    FEN_WIDTHS[ord(piece)] = 1
+    FEN_CODES[ord(piece)] = k + 1
+for k in range(1, 9):
+    FEN_WIDTHS[ord(str(k))] = k
+
+# row k + 1 is the one-hot channel vector of piece index k + 1, row 0 (empty) is zero
+PIECE_ONE_HOT = np.eye(13, dtype=np.uint8)[:, 1:]
+
+
+def fenListToPieceIndices(fenList):
+    """piece indices (0 empty, k + 1 for channel k of getFenPerChannel) of the squares
+    of a list of fens, shape (time, row, column) as uint8, decoded in one pass over
+    the bytes of all fens"""
+    placements = "".join(fen.split(" ", 1)[0] for fen in fenList).encode("ascii")
+    characters = np.frombuffer(placements, dtype=np.uint8)
+    squares = np.repeat(FEN_CODES[characters], FEN_WIDTHS[characters])
+    if len(squares) != 64 * len(fenList):
+        raise ValueError("not a list of valid fen piece placements")
+    return squares.reshape(len(fenList), 8, 8)
+
+
+def fenListToPlanes(fenList):
+    """the planes of getFenPerChannel(fenList_to_fenArray(fenList)), shape (time,
+    channel, row, column), as uint8"""
+    return PIECE_ONE_HOT[fenListToPieceIndices(fenList)].transpose(0, 3, 1, 2)
+
+
+def replayBoards(moveList, max_ply=None):
+    """yield the board after each move of a game, a single python-chess board updated
+    in place. moveList holds SAN strings or int16 move codes (see move_encoding); the
+    replay stops after max_ply plies"""
+    board = chess.Board()
+    if isinstance(moveList, np.ndarray) and moveList.dtype == MOVE_DTYPE:
+        for code in moveList[:max_ply]:
+            board.push(decodeMove(code))
+            yield board
+    else:
+        for move in moveList[:max_ply]:
+            board.push_san(str(move))
+            yield board
+
+
+def getBitboards(board):
+    """the 12 piece bitboards of a board (bit i = square i, A1 = 0), in channel order
+    of getFenPerChannel: P, R, N, B, Q, K, p, r, n, b, q, k"""
+    pieces = (
+        board.pawns,
+        board.rooks,
+        board.knights,
+        board.bishops,
+        board.queens,
+        board.kings,
+    )
+    white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+    return [mask & white for mask in pieces] + [mask & black for mask in pieces]
+
+
+def getPawnAttacks(pawns, color):
+    """squares attacked by all pawns of a bitboard, by shifting it diagonally forward"""
+    if color == chess.WHITE:
+        attacks = ((pawns & ~chess.BB_FILE_A) << 7) | ((pawns & ~chess.BB_FILE_H) << 9)
+    else:
+        attacks = ((pawns & ~chess.BB_FILE_A) >> 9) | ((pawns & ~chess.BB_FILE_H) >> 7)
+    return attacks & chess.BB_ALL
+
+
+def getAttackBitboards(board):
+    """the squares attacked by each piece type of a board as 12 bitboards, in the
+    channel order of getBitboards. Like BaseBoard.attacks, pins and checks are ignored
+    and sliders stop at (and include) the first occupied square"""
+    occupied = board.occupied
+
+    def rankFileAttacks(square):
+        return (
+            chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied]
+            | chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied]
+        )
+
+    def diagonalAttacks(square):
+        return chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+
+    attacks = []
+    for color in (chess.WHITE, chess.BLACK):
+        own = board.occupied_co[color]
+        rookAttacks = 0
+        for square in chess.scan_forward(board.rooks & own):
+            rookAttacks |= rankFileAttacks(square)
+        knightAttacks = 0
+        for square in chess.scan_forward(board.knights & own):
+            knightAttacks |= chess.BB_KNIGHT_ATTACKS[square]
+        bishopAttacks = 0
+        for square in chess.scan_forward(board.bishops & own):
+            bishopAttacks |= diagonalAttacks(square)
+        queenAttacks = 0
+        for square in chess.scan_forward(board.queens & own):
+            queenAttacks |= rankFileAttacks(square) | diagonalAttacks(square)
+        kingAttacks = 0
+        for square in chess.scan_forward(board.kings & own):
+            kingAttacks |= chess.BB_KING_ATTACKS[square]
+        attacks += [
+            getPawnAttacks(board.pawns & own, color),
+            rookAttacks,
+            knightAttacks,
+            bishopAttacks,
+            queenAttacks,
+            kingAttacks,
+        ]
+    return attacks
+
+
+def pieceAttacks(channel, square, occupied):
+    """squares attacked by the piece of channel (see getBitboards) on square"""
+    pieceIndex = channel % 6  # P, R, N, B, Q, K
+    if pieceIndex == 0:
+        color = chess.WHITE if channel < 6 else chess.BLACK
+        return chess.BB_PAWN_ATTACKS[color][square]
+    if pieceIndex == 2:
+        return chess.BB_KNIGHT_ATTACKS[square]
+    if pieceIndex == 5:
+        return chess.BB_KING_ATTACKS[square]
+    attacks = 0
+    if pieceIndex != 3:  # rook or queen
+        attacks |= (
+            chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied]
+            | chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied]
+        )
+    if pieceIndex != 1:  # bishop or queen
+        attacks |= chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+    return attacks
+
+
+class AttackTracker:
+    """the 12 attack bitboards of getAttackBitboards, updated incrementally from one
+    ply to the next. Per square it keeps the attacks of the piece on it; after a move
+    only the squares whose piece changed (moved, captured, promoted, castled) and the
+    sliders whose attacks contain such a square (their rays end at or pass through
+    it) are recomputed, and only the piece types of those squares are ORed again"""
+
+    __slots__ = ("bitboards", "squareAttacks", "attacks")
+
+    def __init__(self):
+        self.bitboards = [0] * 12
+        self.squareAttacks = [0] * 64
+        self.attacks = [0] * 12
+
+    def update(self, board, bitboards=None):
+        """the attack bitboards of board, which follows the board of the last call.
+        bitboards are the piece bitboards of board, if already known"""
+        if bitboards is None:
+            bitboards = getBitboards(board)
+        occupied = board.occupied
+        squareAttacks = self.squareAttacks
+        changed = 0
+        dirty = []
+        for channel, (old, new) in enumerate(zip(self.bitboards, bitboards)):
+            if old != new:
+                changed |= old ^ new
+                dirty.append(channel)
+        if not changed:
+            return list(self.attacks)
+        for channel in range(12):
+            if channel % 6 in (1, 3, 4):  # sliders
+                isDirty = channel in dirty
+                for square in chess.scan_forward(bitboards[channel]):
+                    if squareAttacks[square] & changed or (
+                        isDirty and chess.BB_SQUARES[square] & changed
+                    ):
+                        squareAttacks[square] = pieceAttacks(channel, square, occupied)
+                        if not isDirty:
+                            dirty.append(channel)
+                            isDirty = True
+            elif channel % 6 and channel in dirty:  # knights and kings
+                for square in chess.scan_forward(bitboards[channel] & changed):
+                    squareAttacks[square] = pieceAttacks(channel, square, occupied)
+        self.bitboards = bitboards
+        for channel in dirty:
+            if channel % 6 == 0:  # all pawns of a color at once
+                color = chess.WHITE if channel < 6 else chess.BLACK
+                self.attacks[channel] = getPawnAttacks(bitboards[channel], color)
+                continue
+            attacks = 0
+            for square in chess.scan_forward(bitboards[channel]):
+                attacks |= squareAttacks[square]
+            self.attacks[channel] = attacks
+        return list(self.attacks)
+
+
+def bitboardsToPlanes(bitboards):
+    """turn an array of bitboards of shape (..., 12) into 0/1 planes of shape
+    (..., 12, 8, 8), first row = rank 8 as in a fen"""
+    bitboards = np.ascontiguousarray(bitboards, dtype="<u8")
+    bits = np.unpackbits(bitboards.view(np.uint8), axis=-1, bitorder="little")
+    planes = bits.reshape(bitboards.shape + (8, 8))  # row = rank 1 ... rank 8
+    return planes[..., ::-1, :]
+
+
+def encodeGame(moveList, min_ply, max_ply, cache=None, incremental_attacks=False):
+    """positions and attacks of the plies min_ply to max_ply of a game, replayed once
+    on a python-chess board. Returns None if the game can not be replayed or has no
+    plies in the window. The replay stops at max_ply, moves after it are not checked.
+    With a PositionCache, positions seen before are taken from it. With
+    incremental_attacks the attacks are updated from ply to ply by an AttackTracker
+    instead of recomputed, the planes are the same"""
+    if moveList is None:  # moves preprocess could not encode
+        return None
+    if cache is not None:
+        return encodeGameCached(moveList, min_ply, max_ply, cache)
+    tracker = AttackTracker() if incremental_attacks else None
+    bitboards = []
+    attacks = []
+    try:
+        for ply, board in enumerate(replayBoards(moveList, max_ply)):
+            if ply >= min_ply:  # only keep positions of the middle game!
+                pieces = getBitboards(board)
+                bitboards.append(pieces)
+                if tracker is not None:
+                    attacks.append(tracker.update(board, pieces))
+                else:
+                    attacks.append(getAttackBitboards(board))
+    except ValueError:
+        LOGGER.info("can not replay moves")
+        return None
+    if not bitboards:
+        return None
+    return (
+        bitboardsToPlanes(np.array(bitboards, dtype=np.uint64)),
+        bitboardsToPlanes(np.array(attacks, dtype=np.uint64)),
+    )
+
+
+def prefixKey(moveList, max_ply):
+    """the moves of a game up to max_ply as a tuple, games sort by it into the order
+    of a depth first walk of their move trie"""
+    if isinstance(moveList, np.ndarray) and moveList.dtype == MOVE_DTYPE:
+        return (True, tuple(moveList[:max_ply].tolist()))
+    return (False, tuple(str(move) for move in moveList[:max_ply]))
+
+
+def encodeGames(moveLists, min_ply, max_ply, incremental_attacks=False):
+    """encodeGame for a batch of games, in input order. The games are replayed in the
+    order of their sorted moves on a single board: the moves a game shares with the
+    game before are not replayed, the board is popped back to the common prefix and
+    the planes of the shared plies are reused"""
+    tracker = AttackTracker() if incremental_attacks else None
+    keys = {
+        index: prefixKey(moveList, max_ply)
+        for index, moveList in enumerate(moveLists)
+        if moveList is not None
+    }
+    encoded = [None] * len(moveLists)
+    board = chess.Board()
+    path = []  # the moves on the board
+    planes = []  # the bitboards of positions and attacks of the plies min_ply... of path
+    for index in sorted(keys, key=keys.__getitem__):
+        isCodes, moves = keys[index]
+        shared = 0
+        for move, pathMove in zip(moves, path):
+            if move != pathMove:
+                break
+            shared += 1
+        for _ in range(len(path) - shared):
+            board.pop()
+        del path[shared:]
+        del planes[max(shared - min_ply, 0) :]
+        try:
+            for move in moves[shared:]:
+                if isCodes:
+                    board.push(decodeMove(move))
+                else:
+                    board.push_san(move)
+                path.append(move)
+                if len(path) > min_ply:
+                    pieces = getBitboards(board)
+                    if tracker is not None:
+                        planes.append(pieces + tracker.update(board, pieces))
+                    else:
+                        planes.append(pieces + getAttackBitboards(board))
+        except ValueError:
+            LOGGER.info("can not replay moves")
+            continue
+        if planes:
+            bitboards = np.array(planes, dtype=np.uint64)
+            encoded[index] = (
+                bitboardsToPlanes(bitboards[:, :12]),
+                bitboardsToPlanes(bitboards[:, 12:]),
+            )
+    return encoded
+
+
+PLANES_STRUCT = struct.Struct("<24Q")  # 24 bitboards, the value of a cache entry
+
+
+def encodeGameCached(moveList, min_ply, max_ply, cache):
+    """encodeGame with a PositionCache. The zobrist hash of the piece placement is
+    computed at min_ply and then updated from the bitboards changed by each move; the
+    attack bitboards of a ply are only computed if its hash is not cached"""
+    planes = []
+    try:
+        for ply, board in enumerate(replayBoards(moveList, max_ply)):
+            if ply < min_ply:
+                continue
+            newBitboards = getBitboards(board)
+            if ply == min_ply:
+                key = zobristHash(newBitboards)
+            else:
+                key = updateZobristHash(key, bitboards, newBitboards)
+            bitboards = newBitboards
+            value = cache.get(key)
+            if value is None:
+                value = PLANES_STRUCT.pack(*bitboards, *getAttackBitboards(board))
+                cache.put(key, value)
+            planes.append(value)
+    except ValueError:
+        LOGGER.info("can not replay moves")
+        return None
+    if not planes:
+        return None
+    bitboards = np.frombuffer(b"".join(planes), dtype="<u8").reshape(-1, 24)
+    planes = bitboardsToPlanes(bitboards)
+    return planes[:, :12], planes[:, 12:]
+
+
+# part of the key of every game in a GameCache, increase it whenever a change of the
+# code changes the encoding of a game, so games cached before are encoded again
+ENCODER_VERSION = 1
+
+
+def hashMoves(key, moveList):
+    """update the hash key with the moves of a game"""
+    if moveList is None:
+        key.update(b"null")
+    elif isinstance(moveList, np.ndarray):
+        key.update(moveList.tobytes())
+    else:
+        key.update(" ".join(moveList).encode())
+    key.update(b"\n")
+
+
+def gameKey(moveList, min_ply, max_ply):
+    """GameCache key of a game: hash of its moves, the plies and the encoder version"""
+    key = hashlib.sha256(json.dumps([ENCODER_VERSION, min_ply, max_ply]).encode())
+    hashMoves(key, moveList)
+    return key.digest()
+
+
+def cacheFromOptions(cache_options):
+    """the position cache of this process, None if cache_options has no max_size and
+    path for it"""
+    if not cache_options:
+        return None
+    max_size = cache_options.get("max_size", 0)
+    path = cache_options.get("path")
+    return getPositionCache(max_size, path) if max_size > 0 or path else None
+
+
+def gameCacheFromOptions(cache_options):
+    """the game cache of this process, None if cache_options has no game_path"""
+    if not cache_options or not cache_options.get("game_path"):
+        return None
+    return getGameCache(cache_options["game_path"])
+
+
+def cacheCounters(cache_options):
+    """the lookup counters of the caches of this process, as a Counter"""
+    counters = collections.Counter()
+    cache = cacheFromOptions(cache_options)
+    if cache is not None:
+        counters.update(
+            {
+                "position hits": cache.hits,
+                "position disk_hits": cache.disk_hits,
+                "position misses": cache.misses,
+            }
+        )
+    gameCache = gameCacheFromOptions(cache_options)
+    if gameCache is not None:
+        counters.update({"game hits": gameCache.hits, "game misses": gameCache.misses})
+    return counters
+
+
+def logCacheStats(counters):
+    """log the cache lookups of all processes, added up from the encodeChunk results"""
+    for name in ("position", "game"):
+        lookups = {
+            key.split(" ")[1]: count
+            for key, count in counters.items()
+            if key.startswith(name + " ")
+        }
+        if lookups:
+            hit_rate = 1 - lookups.get("misses", 0) / sum(lookups.values())
+            LOGGER.info(f"{name} cache: {lookups}, hit_rate {hit_rate:.3f}")
+
+
+def encodeUncached(moveLists, min_ply, max_ply, cache_options):
+    """encodeGame for a list of games, with the position cache of cache_options if any;
+    without it the games share the replay of common prefixes (encodeGames)"""
+    cache = cacheFromOptions(cache_options)
+    if cache is None:
+        return encodeGames(moveLists, min_ply, max_ply)
+    encoded = [encodeGame(moveList, min_ply, max_ply, cache) for moveList in moveLists]
+    cache.flush()
+    return encoded
+
+
+def encodeViaGameCache(moveLists, min_ply, max_ply, cache_options, gameCache):
+    """encodeUncached for the games not in gameCache, the others are taken from it"""
+    keys = [gameKey(moveList, min_ply, max_ply) for moveList in moveLists]
+    encoded = [gameCache.get(key) for key in keys]
+    missing = [k for k, value in enumerate(encoded) if value is GameCache.MISSING]
+    newGames = encodeUncached(
+        [moveLists[k] for k in missing], min_ply, max_ply, cache_options
+    )
+    for k, value in zip(missing, newGames):
+        gameCache.put(keys[k], value)
+        encoded[k] = value
+    gameCache.flush()
+    return encoded
+
+
+def encodeChunk(args):
+    """encodeGame for a chunk of games, run in a worker process. With a game cache
+    (game_path of cache_options, see GameCache) only games not cached are encoded.
+    Returns the encoded games and the cache lookups of the chunk (see cacheCounters),
+    the caller adds those up over the processes"""
+    moveLists, min_ply, max_ply, cache_options = args
+    before = cacheCounters(cache_options)
+    gameCache = gameCacheFromOptions(cache_options)
+    if gameCache is None:
+        encoded = encodeUncached(moveLists, min_ply, max_ply, cache_options)
+    else:
+        encoded = encodeViaGameCache(
+            moveLists, min_ply, max_ply, cache_options, gameCache
+        )
+    return encoded, cacheCounters(cache_options) - before
+
+
+def iterEncodedGames(
+    moveLists, min_ply, max_ply, workers=1, games_per_chunk=256, cache_options=None
+):
+    """encodeGame for every game, in input order, encoded in chunks of
+    games_per_chunk games (see encodeChunk), in a process pool with several workers.
+    cache_options configure the caches of each process: max_size and path the
+    PositionCache (see getPositionCache), game_path the GameCache"""
+    tasks = (
+        (moveLists[start : start + games_per_chunk], min_ply, max_ply, cache_options)
+        for start in range(0, len(moveLists), games_per_chunk)
+    )
+    counters = collections.Counter()
+    if workers <= 1:
+        for encoded, chunkCounters in map(encodeChunk, tasks):
+            counters += chunkCounters
+            yield from encoded
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            # imap keeps the order of tasks
+            for encoded, chunkCounters in pool.imap(encodeChunk, tasks):
+                counters += chunkCounters
+                yield from encoded
+    logCacheStats(counters)
+
+
+def iterKeptGames(
+    df, min_ply, max_ply, workers=1, games_per_chunk=256, cache_options=None
+):
+    """(positions, attacks, label) of every game that could be encoded, in input
+    order"""
+    failCounter = 0
+    encodedGames = iterEncodedGames(
+        list(df["moves"]), min_ply, max_ply, workers, games_per_chunk, cache_options
+    )
+    for encoded, label in tqdm(zip(encodedGames, df["opponentIsComp"]), total=len(df)):
+        if encoded is None:
             failCounter += 1
             continue
-        fenList = fenList[min_ply:max_ply]  # only keep positions of the middle game!
-        fenArray = fenList_to_fenArray(fenList)
-        fen_per_channel = getFenPerChannel(fenArray)
-        attacksTensor = getAttacksTensorOverTime(fenList)
+        fen_per_channel, attacksTensor = encoded
 
         if np.count_nonzero(fen_per_channel) > 0:
-            resList.append(fen_per_channel)
-            labelList.append(label)
-            attacksList.append(attacksTensor)
+            yield fen_per_channel, attacksTensor, label
     LOGGER.info(f"failed games: {failCounter}")
+
+
+def getArrayLists(
+    df, min_ply, max_ply, workers=1, games_per_chunk=256, cache_options=None
+):
+    resList = []
+    labelList = []
+    attacksList = []
+    for fen_per_channel, attacksTensor, label in iterKeptGames(
+        df, min_ply, max_ply, workers, games_per_chunk, cache_options
+    ):
+        resList.append(fen_per_channel)
+        labelList.append(label)
+        attacksList.append(attacksTensor)
     return resList, labelList, attacksList
 
 
+def writeArrays(
+    df,
+    min_ply,
+    max_ply,
+    output_path,
+    output_path_labels,
+    output_path_attacks,
+    workers=1,
+    games_per_chunk=256,
+    cache_options=None,
+):
+    """encode the games straight into .npy files preallocated for all games of df,
+    positions and attacks bit packed (see dataset_io). Games shorter than max_ply are
+    skipped, all samples have max_ply - min_ply plies. Returns the number of games
+    written"""
+    sample_shape = (max_ply - min_ply, 12, 8)
+    shortCounter = 0
+    with ArrayWriter(output_path, len(df), sample_shape, np.uint8) as res, ArrayWriter(
+        output_path_attacks, len(df), sample_shape, np.uint8
+    ) as attacks, ArrayWriter(output_path_labels, len(df), (), int) as labels:
+        for fen_per_channel, attacksTensor, label in iterKeptGames(
+            df, min_ply, max_ply, workers, games_per_chunk, cache_options
+        ):
+            if len(fen_per_channel) < sample_shape[0]:
+                shortCounter += 1
+                continue
+            res.append(packPlanes(fen_per_channel))
+            attacks.append(packPlanes(attacksTensor))
+            labels.append(label)
+        count = labels.count
+    LOGGER.info(f"games shorter than max_ply: {shortCounter}")
+    return count
+
+
+def writeGameStore(
+    df,
+    max_game_length,
+    output_dir,
+    workers=1,
+    games_per_chunk=256,
+    cache_options=None,
+):
+    """encode every ply up to max_game_length of every game into a GameStore in
+    output_dir, ply windows are selected when it is read. Returns the number of games
+    written"""
+    max_plies = sum(
+        min(len(moves), max_game_length) for moves in df["moves"] if moves is not None
+    )
+    with GameStoreWriter(output_dir, max_plies) as store:
+        for fen_per_channel, attacksTensor, label in iterKeptGames(
+            df, 0, max_game_length, workers, games_per_chunk, cache_options
+        ):
+            store.append(packPlanes(fen_per_channel), packPlanes(attacksTensor), label)
+        count = len(store.labels)
+    return count
+
+
+def encodeShard(args):
+    """encode the games of a shard and write it, positions and attacks bit packed.
+    Like writeArrays, only games with all plies min_ply to max_ply are kept"""
+    index, moveLists, labels, min_ply, max_ply, path, cache_options = args
+    num_plies = max_ply - min_ply
+    positionList = []
+    attacksList = []
+    kept = []
+    encodedGames, counters = encodeChunk((moveLists, min_ply, max_ply, cache_options))
+    for k, encoded in enumerate(encodedGames):
+        if encoded is None or len(encoded[0]) < num_plies:
+            continue
+        if np.count_nonzero(encoded[0]) > 0:
+            positionList.append(packPlanes(encoded[0]))
+            attacksList.append(packPlanes(encoded[1]))
+            kept.append(k)
+    empty = np.empty((0, num_plies, 12, 8), dtype=np.uint8)
+    positions = np.stack(positionList) if kept else empty
+    attacks = np.stack(attacksList) if kept else empty
+    return index, writeShard(path, positions, attacks, labels[kept]), counters
+
+
+def iterEncodedShards(tasks, workers=1):
+    """encodeShard for every task, in a process pool with several workers; the
+    shards are yielded as they are done"""
+    if workers <= 1:
+        yield from map(encodeShard, tasks)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(encodeShard, tasks)
+
+
+def shardKey(moveLists, labels, min_ply, max_ply):
+    """hash of the input games of a shard, the encoding options and encoder version"""
+    key = hashlib.sha256(json.dumps([ENCODER_VERSION, min_ply, max_ply]).encode())
+    for moveList in moveLists:
+        hashMoves(key, moveList)
+    key.update(np.ascontiguousarray(labels).tobytes())
+    return key.hexdigest()
+
+
+def writeShards(
+    df,
+    min_ply,
+    max_ply,
+    output_dir,
+    shard_size=10000,
+    workers=1,
+    cache_options=None,
+    verify=False,
+):
+    """encode the games into a ShardedDataset in output_dir, shard_size input games
+    per shard. Shards whose games and options did not change since the last run (and
+    whose files have the size, if verify the checksum, of the manifest) are kept, the
+    others are encoded (in a process pool with several workers). The manifest is
+    saved after every shard, a rerun after an interruption keeps the shards done"""
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    dataset = ShardedDataset(output_dir)
+    moveLists = list(df["moves"])
+    labels = df["opponentIsComp"].to_numpy().astype(np.int64)
+    sample_shape = [max_ply - min_ply, 12, 8]
+    arrays = {
+        "positions": {"shape": sample_shape, "dtype": "uint8"},
+        "attacks": {"shape": sample_shape, "dtype": "uint8"},
+        "labels": {"shape": [], "dtype": "int64"},
+    }
+    shards = []
+    tasks = []
+    for index, start in enumerate(range(0, len(df), shard_size)):
+        stop = min(start + shard_size, len(df))
+        key = shardKey(moveLists[start:stop], labels[start:stop], min_ply, max_ply)
+        if dataset.isCurrent(index, key, verify):
+            shards.append(dataset.shards[index])
+            continue
+        shards.append({"games": [start, stop], "key": key})
+        tasks.append(
+            (
+                index,
+                moveLists[start:stop],
+                labels[start:stop],
+                min_ply,
+                max_ply,
+                dataset.shardPath(index),
+                cache_options,
+            )
+        )
+    LOGGER.info(f"encoding {len(tasks)} of {len(shards)} shards")
+    counters = collections.Counter()
+    results = iterEncodedShards(tasks, workers)
+    for index, entry, shardCounters in tqdm(results, total=len(tasks)):
+        shards[index].update(entry)
+        counters += shardCounters
+        # shard files of other workers may not be in the manifest yet, keep them
+        dataset.save(shards, arrays, remove_stale=False)
+    logCacheStats(counters)
+    dataset.save(shards, arrays)
+    return dataset
+
+
 @click.command()
 @click.option(
     "--input-path", help="expects parquet file", required=True, type=click.Path()
@@ -153,31 +840,110 @@ def getArrayLists(df, min_ply, max_ply):
 @click.option(
     "--params-path", help="configuration params",
 )
-@click.option("--output-path", help="where to save result", required=True)
-@click.option("--output-path-labels", help="where to save labels", required=True)
+@click.option("--output-path", help="where to save result")
+@click.option("--output-path-labels", help="where to save labels")
+@click.option("--output-path-attacks", help="where to save attack tensors")
+@click.option(
+    "--output-dir",
+    help="write a sharded data set (shards + dataset_manifest.json) here instead",
+)
+@click.option("--shard-size", default=10000, help="input games per shard")
+@click.option(
+    "--verify-shards",
+    is_flag=True,
+    help="compare the checksums of the shards kept from an earlier run, not only sizes",
+)
+@click.option(
+    "--store-dir",
+    help="write a game store with every ply up to max_game_length here instead, the "
+    "ply window is chosen when training",
+)
+@click.option(
+    "--workers", default=1, help="processes encoding the games in parallel (1 = serial)"
+)
 @click.option(
-    "--output-path-attacks", help="where to save attack tensors", required=True
+    "--games-per-chunk", default=256, help="games sent to a worker process at once"
+)
+@click.option(
+    "--cache-size",
+    default=0,
+    help="positions kept in the in-memory position cache of each process (0 = off)",
+)
+@click.option(
+    "--cache-path", help="sqlite file for a persistent on-disk position cache tier"
+)
+@click.option(
+    "--game-cache-path",
+    help="sqlite file caching every encoded game by its moves, only games not in it "
+    "are encoded",
 )
 def main(
-    input_path, output_path, output_path_labels, output_path_attacks, params_path,
+    input_path,
+    output_path,
+    output_path_labels,
+    output_path_attacks,
+    output_dir,
+    shard_size,
+    verify_shards,
+    store_dir,
+    params_path,
+    workers,
+    games_per_chunk,
+    cache_size,
+    cache_path,
+    game_cache_path,
 ):
-    df = pd.read_parquet(input_path)
+    output_paths = (output_path, output_path_labels, output_path_attacks)
+    if not (store_dir or output_dir or all(output_paths)):
+        raise click.UsageError(
+            "give either --store-dir, --output-dir, or --output-path, "
+            "--output-path-labels and --output-path-attacks"
+        )
+    df = loadGames(input_path)
     with open(params_path) as f:
         params = json.load(f)
+    cache_options = {
+        "max_size": cache_size,
+        "path": cache_path,
+        "game_path": game_cache_path,
+    }
 
-    resList, labelList, attacksList = getArrayLists(
-        df, params["plymin"], params["plymax"]
-    )
-    res = np.stack(resList, axis=0).astype(int)
-    labels = np.array(labelList).astype(int)
-    attacks = np.stack(attacksList, axis=0).astype(int)
-
-    LOGGER.info(
-        f"output shape: {res.shape}, labels shape: {labels.shape}, attacks shape: {attacks.shape}"
+    if store_dir:
+        count = writeGameStore(
+            df,
+            params["max_game_length"],
+            store_dir,
+            workers,
+            games_per_chunk,
+            cache_options,
+        )
+        LOGGER.info(f"wrote every ply of {count} games")
+        return
+    if output_dir:
+        dataset = writeShards(
+            df,
+            params["plymin"],
+            params["plymax"],
+            output_dir,
+            shard_size,
+            workers,
+            cache_options,
+            verify_shards,
+        )
+        LOGGER.info(f"wrote {len(dataset)} games in {len(dataset.shards)} shards")
+        return
+    count = writeArrays(
+        df,
+        params["plymin"],
+        params["plymax"],
+        output_path,
+        output_path_labels,
+        output_path_attacks,
+        workers,
+        games_per_chunk,
+        cache_options,
     )
-    np.savez_compressed(output_path, res)
-    np.savez_compressed(output_path_labels, labels)
-    np.savez_compressed(output_path_attacks, attacks)
+    LOGGER.info(f"wrote {count} games")
 
 
 if __name__ == "__main__":
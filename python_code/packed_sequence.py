@@ -0,0 +1,59 @@
+import math
+
+import numpy as np
+from tensorflow import keras as k
+
+from dataset_io import unpackPlanes
+
+
+class PackedSequence(k.utils.Sequence):
+    """batches of bit packed positions and attacks (see dataset_io), unpacked to
+    float32 only when a batch is requested, so the whole data set stays packed in
+    memory. indices select the samples, labels[i] is the label of sample indices[i]:
+    samples of the arrays of a data set, or (time) plies of a GameStore per sample.
+    A batch has the shape (batch, time, channel, 8, 8), positions and attacks
+    concatenated along the channel axis, or (batch, time, channel * 64) if flatten"""
+
+    def __init__(
+        self,
+        positions,
+        attacks,
+        indices,
+        labels,
+        batch_size=128,
+        flatten=False,
+        shuffle=False,
+    ):
+        super().__init__()
+        self.positions = positions
+        self.attacks = attacks
+        self.indices = np.asarray(indices)
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.flatten = flatten
+        self.shuffle = shuffle
+        self.order = np.arange(len(self.indices))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __getitem__(self, idx):
+        batch = self.order[idx * self.batch_size : (idx + 1) * self.batch_size]
+        first = self.indices[batch].reshape(len(batch), -1)[:, 0]
+        batch = batch[np.argsort(first)]  # read the samples in order
+        samples = self.indices[batch]
+        data = np.concatenate(
+            (
+                unpackPlanes(self.positions[samples]),
+                unpackPlanes(self.attacks[samples]),
+            ),
+            axis=2,
+        )
+        if self.flatten:
+            data = data.reshape(data.shape[0], data.shape[1], -1)
+        return data, self.labels[batch]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
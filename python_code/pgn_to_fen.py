@@ -15,52 +15,97 @@ import re
 import os
 
 
+COLUMNS = 'abcdefgh'
+COLUMN_INDEX = {column: i for i, column in enumerate(COLUMNS)}
+START_BOARD = [
+    'R','N','B','Q','K','B','N','R',
+    'P','P','P','P','P','P','P','P',
+    '1','1','1','1','1','1','1','1',
+    '1','1','1','1','1','1','1','1',
+    '1','1','1','1','1','1','1','1',
+    '1','1','1','1','1','1','1','1',
+    'p','p','p','p','p','p','p','p',
+    'r','n','b','q','k','b','n','r']
+PIECES = 'PRNBQKprnbqk'
+
+
+def _lineTables():
+    """for every pair of squares: 'rook' if they share a row or column, 'bishop' if
+    they share a diagonal, else None; and the squares strictly between them"""
+    lineKind = [[None] * 64 for _ in range(64)]
+    between = [[()] * 64 for _ in range(64)]
+    for a in range(64):
+        for b in range(64):
+            diffRow = b // 8 - a // 8
+            diffCol = b % 8 - a % 8
+            if a == b:
+                continue
+            if diffRow == 0 or diffCol == 0:
+                lineKind[a][b] = 'rook'
+            elif abs(diffRow) == abs(diffCol):
+                lineKind[a][b] = 'bishop'
+            else:
+                continue
+            steps = max(abs(diffRow), abs(diffCol))
+            step = (diffRow // steps) * 8 + diffCol // steps
+            between[a][b] = tuple(a + step * k for k in range(1, steps))
+    return lineKind, between
+
+
+LINE_KIND, BETWEEN = _lineTables()
+# squares a knight can come from, for every target square
+KNIGHT_SOURCES = [
+    frozenset(
+        8 * (square // 8 + dRow) + square % 8 + dCol
+        for dRow, dCol in ((2, -1), (2, 1), (1, -2), (1, 2), (-1, -2), (-1, 2), (-2, -1), (-2, 1))
+        if 0 <= square // 8 + dRow < 8 and 0 <= square % 8 + dCol < 8
+    )
+    for square in range(64)
+]
+EMPTY_RUNS = [('1' * n, str(n)) for n in range(8, 1, -1)]
+
+
 class PgnToFen:
-    fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR'
-    whiteToMove = True
-    internalChessBoard = [
-        'R','N','B','Q','K','B','N','R',
-        'P','P','P','P','P','P','P','P',
-        '1','1','1','1','1','1','1','1',
-        '1','1','1','1','1','1','1','1',
-        '1','1','1','1','1','1','1','1',
-        '1','1','1','1','1','1','1','1',
-        'p','p','p','p','p','p','p','p',
-        'r','n','b','q','k','b','n','r']
-    enpassant = '-'
-    castlingRights = 'KQkq'
+    __slots__ = ('fen', 'whiteToMove', 'internalChessBoard', 'pieceSquares', 'enpassant',
+                 'castlingRights', 'lastMove', 'fens', 'result', 'sucess')
     DEBUG = False
-    lastMove = 'Before first move'
-    fens = []
-    result = ''
+
+    def __init__(self):
+        self.fens = []
+        self.castlingRights = 'KQkq'
+        self.lastMove = 'Before first move'
+        self.sucess = False
+        self.resetBoard()
 
     def getFullFen(self):
         return self.getFen() + ' ' + ('w ' if self.whiteToMove else 'b ') + self.enpassant + ' ' + (self.castlingRights if self.castlingRights else '-')
 
     def getFen(self):
-        fenpos = ''
-        for n in reversed((8,16,24,32,40,48,56,64)):
-            emptyPosLength = 0;
-            for i in self.internalChessBoard[n-8:n]:
-                if(i is not '1'):
-                    if(emptyPosLength is not 0):
-                        fenpos = fenpos + str(emptyPosLength);
-                        emptyPosLength = 0
-                    fenpos = fenpos + i
-                else:
-                    emptyPosLength = emptyPosLength + 1
-            if(emptyPosLength is not 0):
-                fenpos = fenpos + str(emptyPosLength);
-            fenpos = fenpos + '/'
-        fenpos = fenpos[:-1]
+        board = ''.join(self.internalChessBoard)
+        fenpos = '/'.join((board[56:64], board[48:56], board[40:48], board[32:40],
+                           board[24:32], board[16:24], board[8:16], board[0:8]))
+        for run, count in EMPTY_RUNS:
+            fenpos = fenpos.replace(run, count)
         return fenpos
 
+    def setSquare(self, pos, piece):
+        """put piece ('1' = empty) on pos, keeping the per piece square indexes"""
+        old = self.internalChessBoard[pos]
+        if old != '1':
+            self.pieceSquares[old].discard(pos)
+        self.internalChessBoard[pos] = piece
+        if piece != '1':
+            self.pieceSquares[piece].add(pos)
+
+    def squaresOf(self, piece):
+        return sorted(self.pieceSquares[piece])
+
     def printFen(self):
         print(self.getFen())
 
     def moves(self, moves):
         if isinstance(moves, str):
-            nrReCompile = re.compile('[0-9]+\.')
+            nrReCompile = re.compile(r'[0-9]+\.')
             transformedMoves = nrReCompile.sub('', moves)
             pgnMoves = transformedMoves.replace('  ', ' ').split(' ')
             result = pgnMoves[-1:][0]
@@ -209,30 +254,30 @@ class PgnToFen:
     def castelingMove(self, move):
         if(len(move) == 3): #short castling
             if(self.whiteToMove):
-                self.internalChessBoard[7] = '1'
-                self.internalChessBoard[6] = 'K'
-                self.internalChessBoard[5] = 'R'
-                self.internalChessBoard[4] = '1'
+                self.setSquare(7, '1')
+                self.setSquare(6, 'K')
+                self.setSquare(5, 'R')
+                self.setSquare(4, '1')
                 self.castlingRights = self.castlingRights.replace('KQ','')
 
             else:
-                self.internalChessBoard[63] = '1'
-                self.internalChessBoard[62] = 'k'
-                self.internalChessBoard[61] = 'r'
-                self.internalChessBoard[60] = '1'
+                self.setSquare(63, '1')
+                self.setSquare(62, 'k')
+                self.setSquare(61, 'r')
+                self.setSquare(60, '1')
                 self.castlingRights = self.castlingRights.replace('kq', '')
         else: # long castling
             if(self.whiteToMove):
-                self.internalChessBoard[0] = '1'
-                self.internalChessBoard[2] = 'K'
-                self.internalChessBoard[3] = 'R'
-                self.internalChessBoard[4] = '1'
+                self.setSquare(0, '1')
+                self.setSquare(2, 'K')
+                self.setSquare(3, 'R')
+                self.setSquare(4, '1')
                 self.castlingRights = self.castlingRights.replace('KQ', '')
             else:
-                self.internalChessBoard[60] = '1'
-                self.internalChessBoard[59] = 'r'
-                self.internalChessBoard[58] = 'k'
-                self.internalChessBoard[56] = '1'
+                self.setSquare(60, '1')
+                self.setSquare(59, 'r')
+                self.setSquare(58, 'k')
+                self.setSquare(56, '1')
                 self.castlingRights = self.castlingRights.replace('kq', '')
 
     def queenMove(self, move, specificCol, specificRow):
@@ -240,40 +285,29 @@ class PgnToFen:
         row = move[1:2]
         chessBoardNumber = self.placeOnBoard(row, column)
         piece = 'Q' if self.whiteToMove else 'q'
-        possibelPositons = [i for i, pos in enumerate(self.internalChessBoard) if pos == piece]
+        possibelPositons = self.squaresOf(piece)
         self.validQueenMoves(possibelPositons, move, specificCol, specificRow)
-        self.internalChessBoard[chessBoardNumber] = piece
+        self.setSquare(chessBoardNumber, piece)
 
-    def validQueenMoves(self, posistions, move, specificCol, specificRow):
-        newColumn = self.columnToInt(move[:1])
-        newRow = self.rowToInt(move[1:2])
-        newPos = self.placeOnBoard(newRow + 1, move[:1])
-        potensialPosisitionsToRemove=[]
+    def lineCandidates(self, posistions, newPos, kinds, specificCol, specificRow):
+        """the posistions on a line of kinds ('rook', 'bishop') with newPos, matching
+        the disambiguation and with nothing in between"""
+        board = self.internalChessBoard
+        potensialPosisitions = []
         for pos in posistions:
-            (existingRow, existingCol) = self.internalChessBoardPlaceToPlaceOnBoard(pos)
-            diffRow = int(existingRow - newRow)
-            diffCol = int(self.columnToInt(existingCol) - newColumn)
-            if diffRow == 0 or diffCol == 0 or diffRow == diffCol or -diffRow == diffCol or diffRow == -diffCol:
-                if not specificCol or specificCol == existingCol:
-                    if not specificRow or (int(specificRow) -1) == int(existingRow):
-                        xVect = 0
-                        yVect = 0
-                        if abs(diffRow) > abs(diffCol):
-                            xVect = -(diffCol / abs(diffRow))
-                            yVect = -(diffRow / abs(diffRow))
-                        else:
-                            xVect = -(diffCol / abs(diffCol))
-                            yVect = -(diffRow / abs(diffCol))
-                        checkPos = pos
-                        nothingInBetween = True
-                        while(checkPos != newPos):
-                            checkPos = int(checkPos + yVect * 8 + xVect)
-                            if(checkPos == newPos):
-                                continue
-                            if self.internalChessBoard[checkPos] != "1":
-                                nothingInBetween = False
-                        if nothingInBetween:
-                            potensialPosisitionsToRemove.append(pos)
+            if LINE_KIND[pos][newPos] not in kinds:
+                continue
+            if specificCol and specificCol != COLUMNS[pos % 8]:
+                continue
+            if specificRow and (int(specificRow) - 1) != pos // 8:
+                continue
+            if all(board[checkPos] == '1' for checkPos in BETWEEN[pos][newPos]):
+                potensialPosisitions.append(pos)
+        return potensialPosisitions
+
+    def validQueenMoves(self, posistions, move, specificCol, specificRow):
+        newPos = self.placeOnBoard(move[1:2], move[:1])
+        potensialPosisitionsToRemove = self.lineCandidates(posistions, newPos, ('rook', 'bishop'), specificCol, specificRow)
         if len(potensialPosisitionsToRemove) == 1:
             correctPos = potensialPosisitionsToRemove[0];
         else:
@@ -286,7 +320,7 @@ class PgnToFen:
             if len(correctPosToRemove) == 0:
                 raise ValueError('None valid positions to remove from the board')
             correctPos = correctPosToRemove[0]
-        self.internalChessBoard[correctPos] = "1"
+        self.setSquare(correctPos, '1')
         return
 
 
@@ -295,43 +329,16 @@ class PgnToFen:
         row = move[1:2]
         chessBoardNumber = self.placeOnBoard(row, column)
         piece = 'R' if self.whiteToMove else 'r'
-        possibelPositons = [i for i, pos in enumerate(self.internalChessBoard) if pos == piece]
+        possibelPositons = self.squaresOf(piece)
         self.validRookMoves(possibelPositons, move, specificCol, specificRow)
-        self.internalChessBoard[chessBoardNumber] = piece
+        self.setSquare(chessBoardNumber, piece)
 
     def validRookMoves(self, posistions, move, specificCol, specificRow):
-        newColumn = self.columnToInt(move[:1])
-        newRow = self.rowToInt(move[1:2])
-        newPos = self.placeOnBoard(newRow + 1, move[:1])
-        potensialPosisitionsToRemove=[]
+        newPos = self.placeOnBoard(move[1:2], move[:1])
         if(len(posistions) == 1):
-            self.internalChessBoard[posistions[0]] = "1"
+            self.setSquare(posistions[0], '1')
             return
-        for pos in posistions:
-            (existingRow, existingCol) = self.internalChessBoardPlaceToPlaceOnBoard(pos)
-            diffRow = int(existingRow - newRow)
-            diffCol = int(self.columnToInt(existingCol) - newColumn)
-            if diffRow == 0 or diffCol == 0:
-                if not specificCol or specificCol == existingCol:
-                    if not specificRow or (int(specificRow) -1) == int(existingRow):
-                        xVect = 0
-                        yVect = 0
-                        if abs(diffRow) > abs(diffCol):
-                            xVect = -(diffCol / abs(diffRow))
-                            yVect = -(diffRow / abs(diffRow))
-                        else:
-                            xVect = -(diffCol / abs(diffCol))
-                            yVect = -(diffRow / abs(diffCol))
-                        checkPos = pos
-                        nothingInBetween = True
-                        while(checkPos != newPos):
-                            checkPos = int(checkPos + yVect * 8 + xVect)
-                            if(checkPos == newPos):
-                                continue
-                            if self.internalChessBoard[checkPos] != "1":
-                                nothingInBetween = False
-                        if nothingInBetween:
-                            potensialPosisitionsToRemove.append(pos)
+        potensialPosisitionsToRemove = self.lineCandidates(posistions, newPos, ('rook',), specificCol, specificRow)
         if len(potensialPosisitionsToRemove) == 1:
             correctPos = potensialPosisitionsToRemove[0];
         else:
@@ -350,7 +357,7 @@ class PgnToFen:
             self.castlingRights = self.castlingRights.replace('K', '')
         elif(correctPos == (63-8)):
             self.castlingRights = self.castlingRights.replace('q', '')
-        self.internalChessBoard[correctPos] = "1"
+        self.setSquare(correctPos, '1')
         return
 
     def kingMove(self, move, specificCol, specificRow):
@@ -359,11 +366,11 @@ class PgnToFen:
         chessBoardNumber = self.placeOnBoard(row, column)
         piece = 'K' if self.whiteToMove else 'k'
         lostCastleRights = 'Q' if self.whiteToMove else 'q'
-        kingPos = [i for i, pos in enumerate(self.internalChessBoard) if pos == piece]
+        kingPos = self.squaresOf(piece)
         self.castlingRights = self.castlingRights.replace(piece, '')
         self.castlingRights = self.castlingRights.replace(lostCastleRights, '')
-        self.internalChessBoard[chessBoardNumber] = piece
-        self.internalChessBoard[kingPos[0]] = '1'
+        self.setSquare(chessBoardNumber, piece)
+        self.setSquare(kingPos[0], '1')
 
 
     def bishopMove(self, move, specificCol, specificRow):
@@ -371,40 +378,13 @@ class PgnToFen:
         row = move[1:2]
         chessBoardNumber = self.placeOnBoard(row, column)
         piece = 'B' if self.whiteToMove else 'b'
-        possibelPositons = [i for i, pos in enumerate(self.internalChessBoard) if pos == piece]
+        possibelPositons = self.squaresOf(piece)
         self.validBishopMoves(possibelPositons, move, specificCol, specificRow)
-        self.internalChessBoard[chessBoardNumber] = piece
+        self.setSquare(chessBoardNumber, piece)
 
     def validBishopMoves(self, posistions, move, specificCol, specificRow):
-        newColumn = self.columnToInt(move[:1])
-        newRow = self.rowToInt(move[1:2])
-        newPos = self.placeOnBoard(newRow + 1, move[:1])
-        potensialPosisitionsToRemove = []
-        for pos in posistions:
-            (existingRow, existingCol) = self.internalChessBoardPlaceToPlaceOnBoard(pos)
-            diffRow = int(existingRow - newRow)
-            diffCol = int(self.columnToInt(existingCol) - newColumn)
-            if diffRow == diffCol or -diffRow == diffCol or diffRow == -diffCol:
-                if not specificCol or specificCol == existingCol:
-                    if not specificRow or (int(specificRow) -1) == int(existingRow):
-                        xVect = 0
-                        yVect = 0
-                        if abs(diffRow) > abs(diffCol):
-                            xVect = -(diffCol / abs(diffRow))
-                            yVect = -(diffRow / abs(diffRow))
-                        else:
-                            xVect = -(diffCol / abs(diffCol))
-                            yVect = -(diffRow / abs(diffCol))
-                        checkPos = pos
-                        nothingInBetween = True
-                        while(checkPos != newPos):
-                            checkPos = int(checkPos + yVect * 8 + xVect)
-                            if(checkPos == newPos):
-                                continue
-                            if self.internalChessBoard[checkPos] != "1":
-                                nothingInBetween = False
-                        if nothingInBetween:
-                            potensialPosisitionsToRemove.append(pos)
+        newPos = self.placeOnBoard(move[1:2], move[:1])
+        potensialPosisitionsToRemove = self.lineCandidates(posistions, newPos, ('bishop',), specificCol, specificRow)
         if len(potensialPosisitionsToRemove) == 1:
             correctPos = potensialPosisitionsToRemove[0];
         else:
@@ -415,27 +395,24 @@ class PgnToFen:
             if len(correctPosToRemove) > 1:
                 raise ValueError('Several valid positions to remove from the board')
             correctPos = correctPosToRemove[0]
-        self.internalChessBoard[correctPos] = "1"
+        self.setSquare(correctPos, '1')
 
     def knightMove(self, move, specificCol, specificRow):
         column = move[:1]
         row = move[1:2]
         chessBoardNumber = self.placeOnBoard(row, column)
         piece = 'N' if self.whiteToMove else 'n'
-        knightPositons = [i for i, pos in enumerate(self.internalChessBoard) if pos == piece]
+        knightPositons = self.squaresOf(piece)
         self.validKnighMoves(knightPositons, move, specificCol, specificRow)
-        self.internalChessBoard[chessBoardNumber] = piece
+        self.setSquare(chessBoardNumber, piece)
 
     def validKnighMoves(self, posistions, move, specificCol, specificRow):
-        newColumn = self.columnToInt(move[:1])
-        newRow = self.rowToInt(move[1:2])
+        newPos = self.placeOnBoard(move[1:2], move[:1])
         potensialPosisitionsToRemove = []
         for pos in posistions:
-            (existingRow, existingCol) = self.internalChessBoardPlaceToPlaceOnBoard(pos)
-            validatePos = str(int(existingRow - newRow)) + str(int(self.columnToInt(existingCol) - newColumn))
-            if validatePos in ['2-1','21','1-2','12','-1-2','-12','-2-1','-21']:
-                if not specificCol or specificCol == existingCol:
-                    if not specificRow or (int(specificRow) -1) == int(existingRow):
+            if pos in KNIGHT_SOURCES[newPos]:
+                if not specificCol or specificCol == COLUMNS[pos % 8]:
+                    if not specificRow or (int(specificRow) -1) == pos // 8:
                             potensialPosisitionsToRemove.append(pos)
         if len(potensialPosisitionsToRemove) == 1:
             correctPos = potensialPosisitionsToRemove[0];
@@ -449,7 +426,7 @@ class PgnToFen:
             if len(correctPosToRemove) == 0:
                 raise ValueError('None valid positions to remove from the board')
             correctPos = correctPosToRemove[0]
-        self.internalChessBoard[correctPos] = "1"
+        self.setSquare(correctPos, '1')
         return
     def pawnMove(self, toPosition, specificCol, specificRow, takes, promote):
         column = toPosition[:1]
@@ -459,19 +436,19 @@ class PgnToFen:
             piece = promote if self.whiteToMove else promote.lower()
         else:
             piece = 'P' if self.whiteToMove else 'p'
-        self.internalChessBoard[chessBoardNumber] = piece
+        self.setSquare(chessBoardNumber, piece)
         if(takes):
             removeFromRow = (int(row) - 1) if self.whiteToMove else (int(row) + 1)
             posistion = self.placeOnBoard(removeFromRow, specificCol)
-            piece = self.internalChessBoard[posistion] = '1'
+            self.setSquare(posistion, '1')
             if(self.enpassant != '-'):
                 enpassantPos = self.placeOnBoard(self.enpassant[1], self.enpassant[0])
                 toPositionPos = self.placeOnBoard(toPosition[1], toPosition[0])
                 if(self.enpassant == toPosition):
                     if(self.whiteToMove == True):
-                        self.internalChessBoard[chessBoardNumber - 8] = '1'
+                        self.setSquare(chessBoardNumber - 8, '1')
                     else:
-                        self.internalChessBoard[chessBoardNumber + 8] = '1'
+                        self.setSquare(chessBoardNumber + 8, '1')
                         return
 
         else:
@@ -494,7 +471,7 @@ class PgnToFen:
                     self.enpassant = enpassant
                 else:
                     self.enpassant = '-'
-                piece = self.internalChessBoard[posistion] = '1'
+                self.setSquare(posistion % 64, '1')  # a negative index counts from the end
                 return;
             else:
                 if(self.whiteToMove == True):
@@ -518,22 +495,7 @@ class PgnToFen:
 
     def columnToInt(self, char):
         # TODO: char.toLowerCase???
-        if(char == 'a'):
-            return 0
-        elif(char == 'b'):
-            return 1
-        elif(char == 'c'):
-            return 2
-        elif(char == 'd'):
-            return 3
-        elif(char == 'e'):
-            return 4
-        elif(char == 'f'):
-            return 5
-        elif(char == 'g'):
-            return 6
-        elif(char == 'h'):
-            return 7
+        return COLUMN_INDEX.get(char)
 
     def intToColum(self, num):
         # TODO: char.toLowerCase???
@@ -558,15 +520,11 @@ class PgnToFen:
         self.fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR'
         self.whiteToMove = True
         self.enpassant = '-'
-        self.internalChessBoard = [
-            'R','N','B','Q','K','B','N','R',
-            'P','P','P','P','P','P','P','P',
-            '1','1','1','1','1','1','1','1',
-            '1','1','1','1','1','1','1','1',
-            '1','1','1','1','1','1','1','1',
-            '1','1','1','1','1','1','1','1',
-            'p','p','p','p','p','p','p','p',
-            'r','n','b','q','k','b','n','r']
+        self.internalChessBoard = list(START_BOARD)
+        self.pieceSquares = {piece: set() for piece in PIECES}
+        for pos, piece in enumerate(START_BOARD):
+            if piece != '1':
+                self.pieceSquares[piece].add(pos)
         self.result = ''
 
     def printBoard(self):
@@ -647,7 +605,7 @@ class PgnToFen:
             :return int|[int]: Returns the posistion(s) on the board for a piece, if only one pos, a int is return, else a list of int is returned
         """
         correctPiece = piece if self.whiteToMove else piece.lower()
-        posistionsOnBoard = [i for i, pos in enumerate(self.internalChessBoard) if pos == correctPiece]
+        posistionsOnBoard = self.squaresOf(correctPiece)
         if len(posistionsOnBoard) == 1:
             return posistionsOnBoard[0]
         else:
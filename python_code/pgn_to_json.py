@@ -5,41 +5,42 @@
 
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import bz2
+import functools
+import gzip
+import io
 import json
+import mmap
+import multiprocessing
+import queue
+import threading
 import chess.pgn
 import re
-import sys
 import os.path
 from tqdm import tqdm
 import pathlib
 import logging
 from datetime import datetime
-import sys, traceback
+import traceback
+import click
+from header_filter import headersPassPrefilter
 
-log = logging.getLogger().error
-
-for i in [1, 2]:
-    dir_ = sys.argv[i]
-    if not os.path.exists(dir_):
-        raise Exception(dir_ + " not found")
-
-max_games = int(sys.argv[3])
-
-is_join = False
-if len(sys.argv) == 5:
-    if sys.argv[4] == "join":
-        is_join = True
+try:
+    import zstandard
+except ImportError:  # only needed for .pgn.zst input
+    zstandard = None
 
+log = logging.getLogger().error
 
-inp_dir = pathlib.Path(sys.argv[1])
-out_dir = pathlib.Path(sys.argv[2])
+GAME_START_REGEX = re.compile(rb"^\[Event ", re.MULTILINE)
+COMPRESSED_SUFFIXES = (".bz2", ".gz", ".zst")
 
 
 def get_file_list(local_path):
     tree = os.walk(str(local_path))
     file_list = []
     out = []
-    test = r".+pgn$"
+    test = r".+pgn(\.bz2|\.gz|\.zst)?$"
     for i in tree:
         file_list = i[2]
 
@@ -49,23 +50,159 @@ def get_file_list(local_path):
     return out
 
 
-def get_data(pgn_file, max_games):
-    node = chess.pgn.read_game(pgn_file)
+def is_compressed(file_path):
+    return str(file_path).endswith(COMPRESSED_SUFFIXES)
+
+
+def pgn_stem(file_path):
+    """file name without the .pgn (and compression) suffix"""
+    name = pathlib.Path(file_path).name
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+    return name[: -len(".pgn")] if name.endswith(".pgn") else name
+
+
+class PrefetchReader(io.RawIOBase):
+    """reads a (decompressing) binary stream on a background thread, so decompression
+    of the next blocks overlaps with parsing the current one"""
+
+    def __init__(self, stream, block_size=1 << 20, max_blocks=16):
+        super().__init__()
+        self.stream = stream
+        self.block_size = block_size
+        self.blocks = queue.Queue(max_blocks)
+        self.block = memoryview(b"")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prefetch(self):
+        try:
+            while True:
+                block = self.stream.read(self.block_size)
+                if not self._put(block) or not block:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.block:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.blocks.put(block)  # keep signalling the end of the stream
+                return 0
+            self.block = memoryview(block)
+        n = min(len(buffer), len(self.block))
+        buffer[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+
+def open_pgn(file_path, encoding):
+    """open a pgn file in text mode. .bz2, .gz and .zst files are decompressed on the
+    fly on a separate thread, without writing the decompressed file to disk"""
+    file_path = str(file_path)
+    if file_path.endswith(".bz2"):
+        stream = bz2.open(file_path, "rb")
+    elif file_path.endswith(".gz"):
+        stream = gzip.open(file_path, "rb")
+    elif file_path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("reading .zst files requires the zstandard package")
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            open(file_path, "rb"), read_across_frames=True, closefd=True
+        )
+    else:
+        return open(file_path, encoding=encoding)
+    return io.TextIOWrapper(io.BufferedReader(PrefetchReader(stream)), encoding=encoding)
+
+
+def get_moves(game, uci=False):
+    """mainline moves of a game as SAN (or UCI) strings. The moves are pushed onto a
+    single board, instead of replaying the game from the root for every move"""
+    if uci:
+        return [move.uci() for move in game.mainline_moves()]
+    board = game.board()
+    moves = []
+    for move in game.mainline_moves():
+        moves.append(board.san(move))
+        board.push(move)
+    return moves
+
+
+SKIPPED_GAME = "skipped"  # returned instead of a game whose headers were filtered out
+
+
+class HeaderFilterBuilder(chess.pgn.GameBuilder):
+    """game builder that only parses the moves of games whose headers pass
+    header_filter, the movetext of all other games is skipped unparsed"""
+
+    def __init__(self, header_filter):
+        super().__init__()
+        self.header_filter = header_filter
+        self.skipped = False
+
+    def end_headers(self):
+        if not self.header_filter(self.game.headers):
+            self.skipped = True
+            return chess.pgn.SKIP
+
+    def result(self):
+        return SKIPPED_GAME if self.skipped else self.game
+
+
+def get_data(pgn_file, max_games, uci=False, header_filter=None, progress=None):
+    """yield the games of a pgn file as dicts of headers and moves. Reads at most
+    max_games + 1 games; if given, progress counts the games read and filtered"""
+    if header_filter is None:
+        read_game = functools.partial(chess.pgn.read_game, pgn_file)
+    else:
+        read_game = functools.partial(
+            chess.pgn.read_game,
+            pgn_file,
+            Visitor=functools.partial(HeaderFilterBuilder, header_filter),
+        )
+    if progress is None:
+        progress = {}
+    progress.setdefault("games", 0)
+    progress.setdefault("filtered", 0)
     error_counter = 0
     game_counter = 0
-    while node is not None and game_counter <= max_games:
+    while game_counter <= max_games:
+        node = read_game()  # read only when needed, the stream may be continued
+        if node is None:
+            break
         game_counter += 1
+        progress["games"] += 1
+        if node is SKIPPED_GAME:
+            progress["filtered"] += 1
+            continue
         try:
             data = node.headers
 
-            data["moves"] = []
-
-            while node.variations:
-                next_node = node.variation(0)
-                data["moves"].append(
-                    re.sub("\{.*?\}", "", node.board().san(next_node.move))
-                )
-                node = next_node
+            data["moves"] = get_moves(node, uci)
 
             out_dict = {}
 
@@ -73,64 +210,392 @@ def get_data(pgn_file, max_games):
                 out_dict[key] = data.get(key)
 
             # log(data.get('Event'))
-            node = chess.pgn.read_game(pgn_file)
-            yield out_dict
         except:
             error_counter = error_counter + 1
             print("skipping {}".format(error_counter))
-            node = chess.pgn.read_game(pgn_file)
             continue
+        yield out_dict
 
 
-def convert_file(file_path, max_games):
-    file_name = file_path.name.replace(file_path.suffix, "") + ".json"
-    log("convert file " + file_path.name)
-    out_list = []
+def find_game_offsets(file_path, max_games):
+    """byte offsets where the games of a pgn file start (every game opens with an
+    Event tag), limited to the max_games + 1 games get_data would read, and the
+    offset where the last of these games ends"""
+    with open(str(file_path), "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = []
+            for match in GAME_START_REGEX.finditer(mm):
+                if len(offsets) == max_games + 1:
+                    return offsets, match.start()
+                offsets.append(match.start())
+    return offsets, size
+
+
+def split_at_games(offsets, end, games_per_chunk, first=0):
+    """partition the byte range of the games from game number first on into chunks
+    of games_per_chunk games, as (start, stop, first game, number of games)"""
+    chunks = []
+    for i in range(first, len(offsets), games_per_chunk):
+        start = offsets[i] if i else 0  # keep anything before the first Event tag
+        stop = offsets[i + games_per_chunk] if i + games_per_chunk < len(offsets) else end
+        chunks.append((start, stop, i, min(games_per_chunk, len(offsets) - i)))
+    return chunks
+
+
+def parse_chunk(args):
+    """worker: parse the games in one byte range of a pgn file"""
+    file_path, start, stop, n_games, encoding, parse_options = args
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        text = f.read(stop - start).decode(encoding)
+    progress = {}
+    games = list(get_data(io.StringIO(text), n_games - 1, progress=progress, **parse_options))
+    return games, progress["filtered"]
+
+
+def iter_game_chunks(
+    file_path,
+    max_games,
+    encoding,
+    workers=1,
+    games_per_chunk=1000,
+    start=None,
+    **parse_options
+):
+    """yield the games of a pgn file in their original order, in chunks of
+    games_per_chunk games read, each with the progress after the chunk: the number
+    of games read and the byte offset in the file (None for compressed files).
+    Parsing begins at the progress start of an earlier run, if given. With several
+    workers the file is split at game boundaries and the chunks are parsed in a
+    process pool. parse_options are passed on to get_data"""
+    filtered = 0
+    if workers > 1 and is_compressed(file_path):
+        log("compressed files can not be split, parsing {} serially".format(file_path))
+        workers = 1
+    if workers <= 1:
+        with open_pgn(file_path, encoding) as pgn_file:
+            games_read = 0
+            if start:
+                if start["offset"] is not None and not is_compressed(file_path):
+                    pgn_file.seek(start["offset"])
+                else:
+                    for _ in range(start["games"]):
+                        chess.pgn.skip_game(pgn_file)
+                games_read = start["games"]
+            while games_read <= max_games:
+                n_games = min(games_per_chunk, max_games + 1 - games_read)
+                progress = {}
+                games = list(
+                    get_data(pgn_file, n_games - 1, progress=progress, **parse_options)
+                )
+                games_read += progress["games"]
+                filtered += progress["filtered"]
+                offset = None if is_compressed(file_path) else pgn_file.tell()
+                yield games, {"games": games_read, "offset": offset}
+                if progress["games"] < n_games:  # end of file
+                    break
+    else:
+        offsets, end = find_game_offsets(file_path, max_games)
+        chunks = split_at_games(
+            offsets, end, games_per_chunk, start["games"] if start else 0
+        )
+        tasks = [
+            (str(file_path), chunk_start, stop, n_games, encoding, parse_options)
+            for chunk_start, stop, first, n_games in chunks
+        ]
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap(parse_chunk, tasks)
+            for (games, chunk_filtered), (_, stop, first, n_games) in zip(results, chunks):
+                filtered += chunk_filtered
+                yield games, {"games": first + n_games, "offset": stop}
+    if parse_options.get("header_filter") is not None:
+        log("filtered out {} games by their headers".format(filtered))
+
+
+def iter_games(file_path, max_games, encoding, workers=1, **parse_options):
+    """yield the games of a pgn file in their original order, see iter_game_chunks"""
+    for games, progress in iter_game_chunks(
+        file_path, max_games, encoding, workers, **parse_options
+    ):
+        yield from games
+
+
+class GameWriter:
+    """writes games one by one as they are parsed, either as a single JSON array
+    or (jsonl) as JSON Lines with one game per line, so memory stays bounded.
+    Continues a file at an earlier position (bytes written, game count) if given"""
+
+    def __init__(self, path, jsonl=False, position=None):
+        self.jsonl = jsonl
+        if position is None:
+            self.count = 0
+            self.json_file = open(str(path), "w")
+            if not self.jsonl:
+                self.json_file.write("[")
+        else:
+            self.count = position["count"]
+            self.json_file = open(str(path), "r+")
+            self.json_file.truncate(position["bytes"])
+            self.json_file.seek(position["bytes"])
+
+    def write(self, data):
+        data_str = json.dumps(data)
+        if self.jsonl:
+            self.json_file.write(data_str + "\n")
+        else:
+            if self.count:
+                self.json_file.write(",")
+            self.json_file.write(data_str)
+        self.count += 1
+
+    def position(self):
+        """bytes written so far (json.dumps output is ascii) and game count"""
+        self.json_file.flush()
+        return {"bytes": self.json_file.tell(), "count": self.count}
+
+    def close(self):
+        if not self.jsonl:
+            self.json_file.write("]")
+        self.json_file.close()
+
+
+def file_stat(file_path):
     try:
-        json_file = open(str(out_dir / file_name), "w")
-        pgn_file = open(str(file_path), encoding="utf-8-sig")  # changed encoding
+        stat = os.stat(str(file_path))
+    except FileNotFoundError:
+        return None
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+class IngestManifest:
+    """progress of the conversion into out_dir, saved after every chunk of games.
+    For every output file it records the pgn files converted completely, the
+    position in the output after them and a checkpoint (pgn file, games read, byte
+    offset) inside the file being converted. A rerun continues from there, and only
+    converts pgn files that are new"""
+
+    file_name = "ingest_manifest.json"
+
+    def __init__(self, out_dir, options):
+        self.path = out_dir / self.file_name
+        self.out_dir = out_dir
+        self.options = options
+        data = {}
+        if self.path.exists():
+            with open(str(self.path)) as f:
+                data = json.load(f)
+            if data.get("options") != options:
+                log("conversion options changed, ignoring " + str(self.path))
+                data = {}
+        self.outputs = data.get("outputs", {})
+
+    def state(self, output_name):
+        """state of an output file, reset if the output or its pgn files changed"""
+        state = self.outputs.get(output_name)
+        if state is not None:
+            output_stat = file_stat(self.out_dir / output_name)
+            checkpoint = state["checkpoint"]
+            if checkpoint and file_stat(checkpoint["file"]) != checkpoint["stat"]:
+                state["checkpoint"] = checkpoint = None
+            position = (checkpoint or state)["position"]
+            required_bytes = position["bytes"] if position else 0
+            if (
+                output_stat is None
+                or output_stat["size"] < required_bytes
+                or any(file_stat(f) != stat for f, stat in state["files"].items())
+            ):
+                log("{} changed, converting it from scratch".format(output_name))
+                state = None
+        if state is None:
+            state = {"files": {}, "position": None, "checkpoint": None}
+            self.outputs[output_name] = state
+        return state
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(str(tmp_path), "w") as f:
+            json.dump({"options": self.options, "outputs": self.outputs}, f, indent=1)
+        os.replace(str(tmp_path), str(self.path))
+
 
-        for count_d, data in tqdm(enumerate(get_data(pgn_file, max_games), start=0)):
-            # log(file_path.name + " " + str(count_d))
-            out_list.append(data)
+def output_suffix(jsonl):
+    return ".jsonl" if jsonl else ".json"
 
-        log(" save " + file_path.name)
-        json.dump(out_list, json_file)
-        json_file.close()
+
+def convert_files(
+    file_list,
+    output_path,
+    max_games,
+    encoding,
+    jsonl=False,
+    workers=1,
+    manifest=None,
+    games_per_chunk=1000,
+    **parse_options
+):
+    """convert pgn files into one output file. With a manifest, pgn files that
+    were converted before are skipped and an interrupted file is resumed"""
+    if manifest is None:
+        state = {"files": {}, "position": None, "checkpoint": None}
+    else:
+        state = manifest.state(output_path.name)
+    pending = [file for file in file_list if str(file) not in state["files"]]
+    if not pending:
+        log("nothing new to convert for " + output_path.name)
+        return
+    writer = GameWriter(
+        output_path, jsonl, (state["checkpoint"] or state)["position"]
+    )
+    for file in pending:
+        checkpoint = state["checkpoint"]
+        start = checkpoint["progress"] if checkpoint and checkpoint["file"] == str(file) else None
+        if start:
+            log("resuming {} after {} games".format(file, start["games"]))
+        chunks = iter_game_chunks(
+            file, max_games, encoding, workers, games_per_chunk, start, **parse_options
+        )
+        with tqdm() as progress_bar:
+            for games, progress in chunks:
+                for data in games:
+                    writer.write(data)
+                progress_bar.update(len(games))
+                if manifest is not None:
+                    state["checkpoint"] = {
+                        "file": str(file),
+                        "stat": file_stat(file),
+                        "progress": progress,
+                        "position": writer.position(),
+                    }
+                    manifest.save()
+        state["files"][str(file)] = file_stat(file)
+        state["position"] = writer.position()
+        state["checkpoint"] = None
+        if manifest is not None:
+            manifest.save()
+        log(pathlib.Path(file).name)
+    writer.close()
+
+
+def convert_file(file_path, max_games, out_dir, jsonl=False, workers=1, **options):
+    file_name = pgn_stem(file_path) + output_suffix(jsonl)
+    log("convert file " + file_path.name)
+    try:
+        convert_files(
+            [file_path],
+            out_dir / file_name,
+            max_games,
+            "utf-8-sig",  # changed encoding
+            jsonl,
+            workers,
+            **options
+        )
         log("done")
     except Exception as e:
         log(traceback.format_exc(10))
         log("ERROR file " + file_name + " not converted")
 
 
-def create_join_file(file_list, max_games):
+def create_join_file(file_list, max_games, out_dir, jsonl=False, workers=1, **options):
     log(" create_join_file ")
-    name = str(out_dir / "join_data.json")
-    open(name, "w").close()
-    json_file = open(str(out_dir / "join_data.json"), "a")
-    json_file.write("[")
-    for count_f, file in enumerate(file_list, start=0):
-        pgn_file = open(file, encoding="ISO-8859-1")
-        for count_d, data in tqdm(enumerate(get_data(pgn_file, max_games), start=0)):
-            # log(str(count_f) + " " + str(count_d))
-            if count_f or count_d:
-                json_file.write(",")
-            data_str = json.dumps(data)
-            json_file.write(data_str)
-        log(pathlib.Path(file).name)
-    json_file.write("]")
-    json_file.close()
+    convert_files(
+        file_list,
+        out_dir / ("join_data" + output_suffix(jsonl)),
+        max_games,
+        "ISO-8859-1",
+        jsonl,
+        workers,
+        **options
+    )
+
 
+@click.command()
+@click.argument("inp_dir", type=click.Path(exists=True))
+@click.argument("out_dir", type=click.Path(exists=True))
+@click.argument("max_games", type=int)
+@click.argument("mode", required=False, type=click.Choice(["join"]))
+@click.option(
+    "--jsonl",
+    is_flag=True,
+    help="stream one game per line (JSON Lines, .jsonl) instead of a JSON array",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="processes parsing chunks of each pgn file in parallel (1 = serial)",
+)
+@click.option(
+    "--uci", is_flag=True, help="emit moves in UCI notation instead of rendering SAN"
+)
+@click.option(
+    "--params-path",
+    help="preprocess config; if given, only games passing its header filters are parsed",
+)
+@click.option(
+    "--human-color",
+    type=click.Choice(["White", "Black"]),
+    help="with --params-path, keep only games lost by the human playing this color "
+    "(default: keep games for both colors)",
+)
+@click.option(
+    "--chunk-games",
+    default=1000,
+    help="games per parsing chunk, progress is checkpointed after every chunk",
+)
+@click.option(
+    "--no-resume",
+    is_flag=True,
+    help="convert everything from scratch instead of resuming from the manifest",
+)
+def main(
+    inp_dir,
+    out_dir,
+    max_games,
+    mode,
+    jsonl,
+    workers,
+    uci,
+    params_path,
+    human_color,
+    chunk_games,
+    no_resume,
+):
+    inp_dir = pathlib.Path(inp_dir)
+    out_dir = pathlib.Path(out_dir)
+    file_list = get_file_list(inp_dir)
+    options = {"uci": uci, "games_per_chunk": chunk_games}
+    params = None
+    if params_path:
+        with open(params_path) as f:
+            params = json.load(f)
+        options["header_filter"] = functools.partial(
+            headersPassPrefilter, params=params, human_color=human_color
+        )
+    if not no_resume:
+        options["manifest"] = IngestManifest(
+            out_dir,
+            {
+                "mode": mode,
+                "max_games": max_games,
+                "jsonl": jsonl,
+                "uci": uci,
+                "params": params,
+                "human_color": human_color,
+            },
+        )
 
-file_list = get_file_list(inp_dir)
+    start_time = datetime.now()
+    if mode != "join":
+        for file in file_list:
+            convert_file(pathlib.Path(file), max_games, out_dir, jsonl, workers, **options)
+    else:
+        create_join_file(file_list, max_games, out_dir, jsonl, workers, **options)
 
-start_time = datetime.now()
-if not is_join:
-    for file in file_list:
-        convert_file(pathlib.Path(file), max_games)
-else:
-    create_join_file(file_list, max_games)
+    end_time = datetime.now()
+    log("time " + str(end_time - start_time))
 
-end_time = datetime.now()
-log("time " + str(end_time - start_time))
 
+if __name__ == "__main__":
+    main()
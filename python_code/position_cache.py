@@ -0,0 +1,216 @@
+import collections
+import sqlite3
+
+import chess
+import chess.polyglot
+import numpy as np
+
+from dataset_io import packPlanes, unpackPlanes
+
+# polyglot zobrist keys of the 12 channels of moves_to_fen (P, R, N, B, Q, K, p, ...):
+# polyglot numbers the pieces (piece_type - 1) * 2 + 1 for white and + 0 for black
+CHANNEL_KEYS = [
+    chess.polyglot.POLYGLOT_RANDOM_ARRAY[64 * index : 64 * (index + 1)]
+    for index in [
+        (piece_type - 1) * 2 + pivot
+        for pivot in (1, 0)
+        for piece_type in (
+            chess.PAWN,
+            chess.ROOK,
+            chess.KNIGHT,
+            chess.BISHOP,
+            chess.QUEEN,
+            chess.KING,
+        )
+    ]
+]
+
+
+def zobristHash(bitboards):
+    """polyglot zobrist hash of the piece placement given by the 12 piece bitboards,
+    the same as chess.polyglot.ZobristHasher(POLYGLOT_RANDOM_ARRAY).hash_board"""
+    return updateZobristHash(0, [0] * 12, bitboards)
+
+
+def updateZobristHash(key, old_bitboards, new_bitboards):
+    """the hash of new_bitboards from the hash of old_bitboards, only the squares that
+    changed (usually 2 to 4 after a move) are xored in or out"""
+    for keys, old, new in zip(CHANNEL_KEYS, old_bitboards, new_bitboards):
+        for square in chess.scan_forward(old ^ new):
+            key ^= keys[square]
+    return key
+
+
+class PositionCache:
+    """bounded LRU cache of encoded positions, keyed by the zobrist hash of the piece
+    placement. A value is the 24 bitboards of positions and attacks (the (24, 8, 8)
+    planes bit packed, 192 bytes). With a path, entries missing in memory are looked
+    up in (and new entries written to, on flush) an sqlite file, which persists
+    across runs and can be shared by processes"""
+
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.pending = {}  # new entries, written to the sqlite file on flush
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(str(path), timeout=60)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS positions "
+                "(key INTEGER PRIMARY KEY, planes BLOB)"
+            )
+
+    @staticmethod
+    def dbKey(key):
+        return key - (1 << 64) if key >= 1 << 63 else key  # sqlite integers are signed
+
+    def get(self, key):
+        """the planes of key, or None if they are not cached"""
+        planes = self.entries.get(key)
+        if planes is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return planes
+        planes = self.pending.get(key)  # put, then dropped from memory before flush
+        if planes is not None:
+            self.hits += 1
+            self.remember(key, planes)
+            return planes
+        if self.db is not None:
+            row = self.db.execute(
+                "SELECT planes FROM positions WHERE key = ?", (self.dbKey(key),)
+            ).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                self.remember(key, row[0])
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key, planes):
+        self.remember(key, planes)
+        if self.db is not None:
+            self.pending[key] = planes
+
+    def remember(self, key, planes):
+        self.entries[key] = planes
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def flush(self):
+        """write the new entries to the on-disk tier, in one transaction: the write
+        lock of the sqlite file is only held while they are written"""
+        if self.db is not None and self.pending:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO positions VALUES (?, ?)",
+                ((self.dbKey(key), planes) for key, planes in self.pending.items()),
+            )
+            self.db.commit()
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class GameCache:
+    """persistent cache of encoded games in an sqlite file, keyed by a hash of the moves
+    of a game and the encoding options (see moves_to_fen.gameKey). A value is the
+    encodeGame result, positions and attacks bit packed, or NULL for a game that can
+    not be encoded. New games are written on flush. Rebuilding a data set with more
+    games only encodes the new ones"""
+
+    MISSING = object()  # get of a key not in the cache
+
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        self.pending = {}  # new games, written to the sqlite file on flush
+        self.db = sqlite3.connect(str(path), timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS games "
+            "(key BLOB PRIMARY KEY, positions BLOB, attacks BLOB)"
+        )
+
+    def get(self, key):
+        """the encoded game of key (None if it can not be encoded), MISSING if it is
+        not cached"""
+        row = self.pending.get(key)
+        if row is None:
+            row = self.db.execute(
+                "SELECT positions, attacks FROM games WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return self.MISSING
+        self.hits += 1
+        if row[0] is None:
+            return None
+        return tuple(
+            unpackPlanes(np.frombuffer(planes, np.uint8).reshape(-1, 12, 8), np.uint8)
+            for planes in row
+        )
+
+    def put(self, key, encoded):
+        planes = (None, None)
+        if encoded is not None:
+            planes = tuple(packPlanes(array).tobytes() for array in encoded)
+        self.pending[key] = planes
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def flush(self):
+        """write the new games to the sqlite file, in one transaction"""
+        if self.pending:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO games VALUES (?, ?, ?)",
+                ((key,) + planes for key, planes in self.pending.items()),
+            )
+            self.db.commit()
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+_processCaches = {}
+
+
+def getPositionCache(max_size, path=None):
+    """the PositionCache of this process for these options, so the workers of a
+    process pool keep their cache from one chunk of games to the next"""
+    if (max_size, path) not in _processCaches:
+        _processCaches[(max_size, path)] = PositionCache(max_size, path)
+    return _processCaches[(max_size, path)]
+
+
+_processGameCaches = {}
+
+
+def getGameCache(path):
+    """the GameCache of this process for the sqlite file path"""
+    if path not in _processGameCaches:
+        _processGameCaches[path] = GameCache(path)
+    return _processGameCaches[path]
@@ -1,21 +1,120 @@
 import pandas as pd
 import click
 import logging
+import hashlib
 import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather
+import pyarrow.ipc
+import pyarrow.parquet
+from move_encoding import encodeMoves
 
 logging.basicConfig(level=logging.INFO,)
 
 LOGGER = logging.getLogger()
 
+JSONL_CHUNKSIZE = 100000  # games parsed at once when reading JSON Lines
 
-def loadData(file_list):
-    df = pd.DataFrame()
-    for file in file_list:
-        data = pd.read_json(file)
-        df = df.append(data, ignore_index=True)
+# the headers identifying a game besides its moves; Event is not one of them, the
+# same FICS game can be exported under different events
+DEDUP_HEADERS = ["White", "Black", "Date", "Time", "Result"]
+
+# the only columns prefilterGames and the deduplication need, out of all pgn headers
+PREPROCESS_COLUMNS = [
+    "PlyCount",
+    "TimeControl",
+    "Result",
+    "WhiteIsComp",
+    "BlackIsComp",
+    "White",
+    "Black",
+    "Date",
+    "Time",
+    "moves",
+]
+
+
+def readGames(file, columns=None):
+    """read games written by pgn_to_json.py, either a JSON array or JSON Lines (.jsonl),
+    or a Parquet (.parquet) / Arrow (.arrow, .feather) table. JSON Lines are parsed chunk
+    by chunk instead of as one monolithic document. If columns are given, only these
+    are kept (columns missing in the file are filled with NaN); Parquet and Arrow files
+    only read them from disk. Headers stay strings, JSON dates are not parsed"""
+    file = str(file)
+    if file.endswith(".parquet"):
+        schema = pyarrow.parquet.read_schema(file)
+        df = pd.read_parquet(file, columns=availableColumns(schema, columns))
+    elif file.endswith((".arrow", ".feather")):
+        schema = pyarrow.ipc.open_file(file).schema
+        df = pyarrow.feather.read_table(
+            file, columns=availableColumns(schema, columns)
+        ).to_pandas()
+    elif file.endswith(".jsonl"):
+        chunks = pd.read_json(
+            file, lines=True, chunksize=JSONL_CHUNKSIZE, convert_dates=False
+        )
+        if columns is not None:
+            chunks = (chunk.reindex(columns=columns) for chunk in chunks)
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        df = pd.read_json(file, convert_dates=False)
+    if columns is not None:
+        df = df.reindex(columns=columns)
     return df
 
 
+def iterGameChunks(file, columns=None, chunksize=JSONL_CHUNKSIZE):
+    """like readGames, but yields the games of a file in DataFrames of up to chunksize
+    rows. JSON Lines, Parquet and Arrow files are streamed, JSON arrays can only be
+    parsed as a whole and are split afterwards"""
+    file = str(file)
+    if file.endswith(".parquet"):
+        parquet_file = pyarrow.parquet.ParquetFile(file)
+        batches = parquet_file.iter_batches(
+            batch_size=chunksize,
+            columns=availableColumns(parquet_file.schema_arrow, columns),
+        )
+    elif file.endswith((".arrow", ".feather")):
+        table = pyarrow.feather.read_table(
+            file, columns=availableColumns(pyarrow.ipc.open_file(file).schema, columns)
+        )  # memory mapped
+        batches = table.to_batches(max_chunksize=chunksize)
+    elif file.endswith(".jsonl"):
+        batches = pd.read_json(
+            file, lines=True, chunksize=chunksize, convert_dates=False
+        )
+    else:
+        LOGGER.info("{} is a JSON array, it is loaded completely".format(file))
+        df = readGames(file, columns)
+        batches = (df[i : i + chunksize] for i in range(0, len(df), chunksize))
+    for batch in batches:
+        df = batch if isinstance(batch, pd.DataFrame) else batch.to_pandas()
+        yield df if columns is None else df.reindex(columns=columns)
+
+
+def availableColumns(schema, columns):
+    if columns is None:
+        return None
+    return [column for column in columns if column in schema.names]
+
+
+def loadData(file_list, columns=PREPROCESS_COLUMNS, workers=None):
+    """read the needed columns of all files in parallel processes, concatenated once"""
+    workers = workers or min(len(file_list), os.cpu_count())
+    read = partial(readGames, columns=columns)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            frames = list(pool.map(read, file_list))
+    else:
+        frames = [read(file) for file in file_list]
+    return pd.concat(frames, ignore_index=True)
+
+
 def balanceEngineRatio(df):
     df_comp = df[df.opponentIsComp == 1.0]
     df_human = df[df.opponentIsComp == 0.0]
@@ -26,8 +125,14 @@ def balanceEngineRatio(df):
     return df
 
 
-def prefilterGames(df, params, human_color):
-    """we want games where the human player (with color human_color) lost, and the opponent is 50/50 human or computer"""
+def isCompToFloat(column):
+    column = column.astype(object)
+    column = column.where(column.notnull(), 0.0)  # field is null for human vs human games
+    return column.mask(column == "Yes", 1.0)
+
+
+def filterSharedCriteria(df, params):
+    """the filters of prefilterGames that do not depend on the human color"""
     min_game_length = params["plymax"] # need at least as many moves as will be used in algorithm
     max_game_length = params["max_game_length"]
     df = df[
@@ -37,13 +142,83 @@ def prefilterGames(df, params, human_color):
     # choose timecontrol. Very short games are weird (and hard to use engines on due to computation time)
     df = df[df["TimeControl"].isin(params["timecontrols"])]
 
-    df.loc[
-        df["WhiteIsComp"].isnull(), "WhiteIsComp"
-    ] = 0.0  # field is null for human vs human games
-    df.loc[df["WhiteIsComp"] == "Yes", "WhiteIsComp"] = 1.0
-    df.loc[df["BlackIsComp"].isnull(), "BlackIsComp"] = 0.0
-    df.loc[df["BlackIsComp"] == "Yes", "BlackIsComp"] = 1.0
+    df = df.assign(
+        WhiteIsComp=isCompToFloat(df["WhiteIsComp"]),
+        BlackIsComp=isCompToFloat(df["BlackIsComp"]),
+    )
+    return df
+
+
+def gameKeys(df):
+    """64 bit hashes of the games of df, over the DEDUP_HEADERS (stripped and lower
+    case, missing ones empty) and the moves"""
+    headers = [
+        df[column].fillna("").astype(str).str.strip().str.lower()
+        if column in df
+        else pd.Series("", index=df.index)
+        for column in DEDUP_HEADERS
+    ]
+    digests = []
+    for *values, moves in zip(*headers, df["moves"]):
+        if not isinstance(moves, (list, np.ndarray)):
+            moves = []
+        game = "\x1f".join(values) + "\x1e" + " ".join(map(str, moves))
+        digests.append(hashlib.blake2b(game.encode(), digest_size=8).digest())
+    return np.frombuffer(b"".join(digests), dtype="<u8")
+
+
+class GameDeduplicator:
+    """drops games whose gameKeys were seen before, in this or an earlier DataFrame, so
+    games can be deduplicated chunk by chunk across all input files. The keys seen are
+    kept in sorted uint64 runs, 8 bytes per distinct game: every chunk adds a run, and
+    runs are merged when a run is not smaller than the one before, so there are only
+    O(log n) runs and every key is copied O(log n) times"""
+
+    def __init__(self):
+        self.runs = []
+        self.games = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def known(self, keys):
+        """which of the sorted keys were seen before"""
+        known = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            known |= run[positions] == keys
+        return known
 
+    def filter(self, df):
+        keys = gameKeys(df)
+        order = np.argsort(keys, kind="stable")  # sorted lookups are cache friendly
+        sortedKeys = keys[order]
+        isFirst = np.ones(len(keys), dtype=bool)  # first in this chunk
+        isFirst[1:] = sortedKeys[1:] != sortedKeys[:-1]
+        keepSorted = isFirst & ~self.known(sortedKeys)
+        keep = np.zeros(len(keys), dtype=bool)
+        keep[order] = keepSorted
+        if keepSorted.any():
+            self.runs.append(sortedKeys[keepSorted])
+            while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+                run = self.runs.pop()
+                self.runs[-1] = np.sort(np.concatenate((self.runs[-1], run)))
+        self.games += len(keys)
+        self.duplicates += len(keys) - int(keep.sum())
+        return df[keep]
+
+    def log(self):
+        LOGGER.info(
+            "duplicate games: {} of {}, {} distinct".format(
+                self.duplicates, self.games, len(self)
+            )
+        )
+
+
+def selectHumanColor(df, human_color):
+    """games (after filterSharedCriteria) where the human player with color
+    human_color lost, with the opponent label"""
     if human_color == "White":
         df = df[df["WhiteIsComp"] == 0.0]
         df = df[
@@ -56,30 +231,244 @@ def prefilterGames(df, params, human_color):
         df = df.rename(columns={"WhiteIsComp": "opponentIsComp"})
 
     df = df[["opponentIsComp", "moves"]]
+    df = df[df.opponentIsComp.isin([0.0, 1.0])]  # balanceEngineRatio keeps no others
+    return df.astype({"opponentIsComp": float})
+
+
+def filterGames(df, params, human_color):
+    """the row filters of prefilterGames, without balancing the engine ratio"""
+    return selectHumanColor(filterSharedCriteria(df, params), human_color)
+
+
+def prefilterGames(df, params, human_color):
+    """we want games where the human player (with color human_color) lost, and the opponent is 50/50 human or computer"""
+    df = filterGames(df, params, human_color)
     df = balanceEngineRatio(df)
     return df
 
 
+OUTPUT_SCHEMA = pa.schema(
+    [("opponentIsComp", pa.float64()), ("moves", pa.list_(pa.string()))]
+)
+# moves_encoded replaces the SAN strings by int16 codes (see move_encoding), null if
+# the moves could not be parsed
+ENCODED_OUTPUT_SCHEMA = pa.schema(
+    [("opponentIsComp", pa.float64()), ("moves_encoded", pa.list_(pa.int16()))]
+)
+
+
+def encodeMovesColumn(df):
+    df = df.assign(moves_encoded=df["moves"].map(encodeMoves))
+    return df[["opponentIsComp", "moves_encoded"]]
+
+
+def writeChunk(writer, df):
+    if len(df):
+        writer.write_table(
+            pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+        )
+
+
+def writeOutput(df, path, encode_moves=False):
+    if encode_moves:
+        table = pa.Table.from_pandas(
+            encodeMovesColumn(df), schema=ENCODED_OUTPUT_SCHEMA, preserve_index=False
+        )
+        pyarrow.parquet.write_table(table, path)
+    else:
+        df.to_parquet(path)
+
+
+def writeFilteredChunks(chunks, params, filtered_paths, deduplicator=None):
+    """out-of-core pass 1: filter chunk by chunk, for every human color append the
+    surviving games to its parquet file and count the games per opponent class.
+    The color independent filters (and the GameDeduplicator, if given) run only once
+    per chunk"""
+    counts = {color: {0.0: 0, 1.0: 0} for color in filtered_paths}
+    writers = {
+        color: pyarrow.parquet.ParquetWriter(path, OUTPUT_SCHEMA)
+        for color, path in filtered_paths.items()
+    }
+    for chunk in chunks:
+        shared = filterSharedCriteria(chunk, params)
+        if deduplicator is not None:
+            shared = deduplicator.filter(shared)
+        for color, writer in writers.items():
+            df = selectHumanColor(shared, color)
+            writeChunk(writer, df)
+            for label, count in df.opponentIsComp.value_counts().items():
+                counts[color][label] += count
+    for writer in writers.values():
+        writer.close()
+    return counts
+
+
+def balanceAndShuffleChunked(
+    filtered_path, output_path, n_min, chunksize, tmp_dir, encode_moves=False
+):
+    """out-of-core balanceEngineRatio: keep the first n_min games of each opponent
+    class (as the in-memory version does) and shuffle them with a two-pass bucket
+    shuffle. Every game goes to a random bucket file of about chunksize games, then
+    each bucket is shuffled in memory and appended to the output"""
+    rng = np.random.default_rng()
+    n_buckets = max(1, -(-2 * n_min // chunksize))
+    bucket_paths = [
+        os.path.join(tmp_dir, "bucket_{}.parquet".format(i)) for i in range(n_buckets)
+    ]
+    buckets = [
+        pyarrow.parquet.ParquetWriter(path, OUTPUT_SCHEMA) for path in bucket_paths
+    ]
+    kept = {0.0: 0, 1.0: 0}
+    for batch in pyarrow.parquet.ParquetFile(filtered_path).iter_batches(chunksize):
+        df = batch.to_pandas()
+        keep = np.zeros(len(df), dtype=bool)
+        for label in kept:
+            is_label = (df.opponentIsComp == label).values
+            rank = kept[label] + np.cumsum(is_label)  # running number within the class
+            keep |= is_label & (rank <= n_min)
+            kept[label] += is_label.sum()
+        df = df[keep]
+        bucket_ids = rng.integers(n_buckets, size=len(df))
+        for i, bucket in enumerate(buckets):
+            writeChunk(bucket, df[bucket_ids == i])
+    for bucket in buckets:
+        bucket.close()
+    schema = ENCODED_OUTPUT_SCHEMA if encode_moves else OUTPUT_SCHEMA
+    with pyarrow.parquet.ParquetWriter(output_path, schema) as writer:
+        for path in bucket_paths:
+            df = pd.read_parquet(path)
+            df = df.iloc[rng.permutation(len(df))]  # reshuffle
+            writeChunk(writer, encodeMovesColumn(df) if encode_moves else df)
+            os.remove(path)
+
+
+def preprocessChunked(
+    file_list, params, output_paths, chunksize, encode_moves=False, dedup=True
+):
+    """prefilterGames for data larger than memory: at most a few chunks of chunksize
+    games are held in memory at a time. output_paths maps each human color to its
+    output file, all colors are filtered in the same pass over the input. With dedup,
+    games seen before in any input file are dropped.
+    Returns the number of games written per color"""
+    n_games = {}
+    output_dir = os.path.dirname(os.path.abspath(next(iter(output_paths.values()))))
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        filtered_paths = {
+            color: os.path.join(tmp_dir, "filtered_{}.parquet".format(color))
+            for color in output_paths
+        }
+        chunks = (
+            chunk
+            for file in file_list
+            for chunk in iterGameChunks(file, PREPROCESS_COLUMNS, chunksize)
+        )
+        deduplicator = GameDeduplicator() if dedup else None
+        counts = writeFilteredChunks(chunks, params, filtered_paths, deduplicator)
+        if deduplicator is not None:
+            deduplicator.log()
+        for color, output_path in output_paths.items():
+            n_min = int(min(counts[color].values()))
+            balanceAndShuffleChunked(
+                filtered_paths[color],
+                output_path,
+                n_min,
+                chunksize,
+                tmp_dir,
+                encode_moves,
+            )
+            n_games[color] = 2 * n_min
+    return n_games
+
+
 @click.command()
 @click.option(
     "--input-paths", help="filenames of input files, separated by comma", required=True
 )
 @click.option("--params-path", help="path to config file", required=True)
-@click.option("--output-path", help="where to save result (as parquet)", required=True)
+@click.option("--output-path", help="where to save result (as parquet)")
+@click.option("--human-color", help="Black or White, what was the human playing")
+@click.option(
+    "--output-path-white",
+    help="with --output-path-black instead of --output-path and --human-color: "
+    "write the games of both human colors in one run",
+)
+@click.option(
+    "--output-path-black",
+    help="where to save the games with a human playing black, with --output-path-white",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="processes reading the input files (default: one per file, up to the cpu count)",
+)
+@click.option(
+    "--chunksize",
+    type=int,
+    help="process the games out of core in chunks of this many games, "
+    "for data larger than memory",
+)
+@click.option(
+    "--encode-moves",
+    is_flag=True,
+    help="store the moves as int16 codes (moves_encoded), replayable without SAN parsing",
+)
 @click.option(
-    "--human-color", help="Black or White, what was the human playing", required=True
+    "--keep-duplicates",
+    is_flag=True,
+    help="do not drop games that occur more than once (same players, date, time, "
+    "result and moves) in the input files",
 )
-def main(input_paths, output_path, params_path, human_color):
+def main(
+    input_paths,
+    output_path,
+    params_path,
+    human_color,
+    output_path_white,
+    output_path_black,
+    workers,
+    chunksize,
+    encode_moves,
+    keep_duplicates,
+):
+    if output_path and human_color:
+        output_paths = {human_color: output_path}
+    elif output_path_white and output_path_black:
+        output_paths = {"White": output_path_white, "Black": output_path_black}
+    else:
+        raise click.UsageError(
+            "give either --output-path and --human-color, "
+            "or --output-path-white and --output-path-black"
+        )
     with open(params_path) as f:
         params = json.load(f)
     file_list = input_paths.split(",")
     n_files = len(file_list)
     LOGGER.info("found {} files".format(n_files))
-    df = loadData(file_list)
-    df = prefilterGames(df, params, human_color)
+    if chunksize:
+        n_games = preprocessChunked(
+            file_list,
+            params,
+            output_paths,
+            chunksize,
+            encode_moves,
+            dedup=not keep_duplicates,
+        )
+        for color, n in n_games.items():
+            LOGGER.info("number of games after preprocessing ({}): {}".format(color, n))
+        return
+    df = loadData(file_list, workers=workers)
+    df = filterSharedCriteria(df, params)  # once for all colors
+    if not keep_duplicates:
+        deduplicator = GameDeduplicator()
+        df = deduplicator.filter(df)
+        deduplicator.log()
 
-    LOGGER.info("number of games after preprocessing: {}".format(df.shape[0]))
-    df.to_parquet(output_path)
+    for color, path in output_paths.items():
+        df_color = balanceEngineRatio(selectHumanColor(df, color))
+        LOGGER.info(
+            "number of games after preprocessing ({}): {}".format(color, df_color.shape[0])
+        )
+        writeOutput(df_color, path, encode_moves)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+import chess
+
+# a game that can not be replayed, the white king can not reach e3 in one move
+UNREPLAYABLE_MOVES = ["e4", "Ke3"]
+
+
+def randomGameMoves(num_plies, rng):
+    """SAN moves of a game with (up to) num_plies random legal moves"""
+    board = chess.Board()
+    moves = []
+    while len(moves) < num_plies and not board.is_game_over():
+        move = rng.choice(list(board.legal_moves))
+        moves.append(board.san(move))
+        board.push(move)
+    return moves
+
+
+def randomGames(num_games, num_plies, rng, unreplayable=()):
+    """the moves of num_games random games (see randomGameMoves), num_plies is a
+    number or a range to draw it from. The games at the indices in unreplayable are
+    replaced by UNREPLAYABLE_MOVES"""
+    games = []
+    for _ in range(num_games):
+        length = rng.choice(num_plies) if isinstance(num_plies, range) else num_plies
+        games.append(randomGameMoves(length, rng))
+    for index in unreplayable:
+        games[index] = list(UNREPLAYABLE_MOVES)
+    return games
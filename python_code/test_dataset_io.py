@@ -0,0 +1,31 @@
+import numpy as np
+
+import dataset_io
+
+
+def test_packPlanes_roundtrip(tmp_path):
+    planes = np.random.default_rng(0).integers(0, 2, size=(3, 5, 12, 8, 8))
+    packed = dataset_io.packPlanes(planes)
+    assert packed.shape == (3, 5, 12, 8)
+    assert packed.dtype == np.uint8
+    assert np.array_equal(dataset_io.unpackPlanes(packed), planes)
+    assert dataset_io.unpackPlanes(packed).dtype == np.float32
+
+    # files written before packing hold the int planes in arr_0 of a .npz
+    np.savez_compressed(tmp_path / "legacy.npz", planes)
+    assert np.array_equal(dataset_io.loadPacked(tmp_path / "legacy.npz"), packed)
+
+
+def test_ArrayWriter_shrinks_to_samples_written(tmp_path):
+    samples = np.random.default_rng(0).integers(0, 256, size=(7, 5, 12, 8))
+    writer = dataset_io.ArrayWriter(tmp_path / "a.npy", 10, (5, 12, 8), np.uint8)
+    for sample in samples:
+        writer.append(sample)
+    assert writer.close() == 7
+    res = dataset_io.loadPacked(tmp_path / "a.npy")
+    assert res.shape == (7, 5, 12, 8)
+    assert np.array_equal(res, samples)
+
+    with dataset_io.ArrayWriter(tmp_path / "labels.npy", 3, (), int) as writer:
+        writer.append(1)
+    assert dataset_io.loadLabels(tmp_path / "labels.npy").tolist() == [1]
@@ -1,8 +1,16 @@
 import sys
 
 print(sys.path)
+import random
+
+import chess
+import dataset_io
 import moves_to_fen as mtf
 import numpy as np
+import pandas as pd
+import pytest
+from move_encoding import encodeMoves
+from random_games import randomGameMoves, randomGames
 
 
 def test_movesToFenList():
@@ -398,3 +406,250 @@ def test_getAttacksTensorOverTime():
 
     assert np.array_equal(res, expected)
 
+
+
+def test_encodeGame_positions_match_fen_path():
+    rng = random.Random(0)
+    compared = 0
+    for _ in range(30):
+        moves = randomGameMoves(120, rng)
+        fenList = mtf.movesToFenList(moves)
+        if fenList is None:  # moves PgnToFen can not follow
+            continue
+        expected = mtf.getFenPerChannel(mtf.fenList_to_fenArray(fenList))
+        res = mtf.encodeGame(moves, 0, len(moves))[0]
+        assert res.dtype == np.uint8
+        assert np.array_equal(res, expected)
+        compared += 1
+    assert compared > 0
+
+
+def test_fenListToPlanes_matches_fenList_to_fenArray():
+    rng = random.Random(5)
+    fenList = []
+    for _ in range(10):
+        board = chess.Board()
+        for move in randomGameMoves(80, rng):
+            board.push_san(move)
+            fenList.append(board.fen())
+    res = mtf.fenListToPlanes(fenList)
+    assert res.dtype == np.uint8
+    assert np.array_equal(res, mtf.getFenPerChannel(mtf.fenList_to_fenArray(fenList)))
+    with pytest.raises(ValueError):
+        mtf.fenListToPlanes(["rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBN w KQkq - 0 1"])
+
+
+def test_encodeGame_attacks_match_fen_path():
+    rng = random.Random(1)
+    for _ in range(30):
+        moves = randomGameMoves(150, rng)
+        board = chess.Board()
+        fenList = []
+        for move in moves:
+            board.push_san(move)
+            fenList.append(board.board_fen())
+        positions, attacks = mtf.encodeGame(moves, 10, 100)
+        assert np.array_equal(
+            positions, mtf.getFenPerChannel(mtf.fenList_to_fenArray(fenList[10:100]))
+        )
+        assert np.array_equal(attacks, mtf.getAttacksTensorOverTime(fenList[10:100]))
+
+
+def test_encodeGames_matches_encodeGame():
+    rng = random.Random(6)
+    openings = [randomGameMoves(12, rng) for _ in range(3)]
+    games = []
+    for k in range(24):
+        board = chess.Board()
+        moves = list(openings[k % 3][: rng.randrange(13)])
+        for move in moves:
+            board.push_san(move)
+        while len(moves) < 50 and not board.is_game_over():
+            move = rng.choice(list(board.legal_moves))
+            moves.append(board.san(move))
+            board.push(move)
+        games.append(moves)
+    games[5] = games[2][:20] + ["Ke8"] + games[2][21:]  # illegal, fails to replay
+    games[7] = games[1][:8]  # ends before min_ply
+    games[9] = list(games[3])  # a duplicate
+    games[11] = None  # moves preprocess could not encode
+    games.append(encodeMoves(games[0]))
+    res = mtf.encodeGames(games, 10, 40)
+    for moves, encoded in zip(games, res):
+        expected = mtf.encodeGame(moves, 10, 40)
+        if expected is None:
+            assert encoded is None
+            continue
+        assert all(np.array_equal(a, b) for a, b in zip(expected, encoded))
+    assert res[5] is None and res[7] is None and res[11] is None
+
+
+def test_getArrayLists_parallel_matches_serial():
+    moves = randomGames(9, 40, random.Random(2), unreplayable=[4])
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [k % 2 for k in range(9)]})
+    serial = mtf.getArrayLists(df, 2, 30)
+    parallel = mtf.getArrayLists(df, 2, 30, workers=2, games_per_chunk=2)
+    assert len(serial[0]) == 8
+    assert serial[1] == [0, 1, 0, 1, 1, 0, 1, 0]
+    for expected, res in zip(serial, parallel):
+        assert len(res) == len(expected)
+        assert all(np.array_equal(a, b) for a, b in zip(expected, res))
+
+
+def test_games_without_encoded_moves_are_skipped():
+    # preprocess writes null moves_encoded for games it can not encode
+    moves = randomGameMoves(30, random.Random(8))
+    df = pd.DataFrame(
+        {"moves": [encodeMoves(moves), None, moves], "opponentIsComp": [0, 1, 1]}
+    )
+    assert mtf.encodeGame(None, 5, 20) is None
+    resList, labelList, attacksList = mtf.getArrayLists(df, 5, 20)
+    assert labelList == [0, 1]
+    assert np.array_equal(resList[0], resList[1])
+
+
+def test_encodeGame_stops_at_max_ply():
+    moves = randomGameMoves(30, random.Random(3))
+    expected = mtf.encodeGame(moves, 5, 20)
+    # moves after max_ply are not replayed, an illegal one there does not matter
+    res = mtf.encodeGame(moves[:20] + ["Ke8"], 5, 20)
+    assert res[0].shape == (15, 12, 8, 8)
+    assert all(np.array_equal(a, b) for a, b in zip(expected, res))
+    fenList = mtf.movesToFenList(moves + ["Ke8"], 5, 20)
+    assert np.array_equal(
+        res[0], mtf.getFenPerChannel(mtf.fenList_to_fenArray(fenList))
+    )
+
+
+def test_writeArrays_matches_getArrayLists(array_paths):
+    moves = randomGames(6, 40, random.Random(4), unreplayable=[1])
+    moves[3] = moves[3][:20]  # shorter than max_ply, skipped
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [0, 1, 0, 1, 1, 0]})
+    assert mtf.writeArrays(df, 5, 30, *array_paths) == 4
+    resList, labelList, attacksList = mtf.getArrayLists(df.drop(index=3), 5, 30)
+    assert np.array_equal(
+        dataset_io.unpackPlanes(dataset_io.loadPacked(array_paths[0]), np.uint8),
+        np.stack(resList),
+    )
+    assert dataset_io.loadLabels(array_paths[1]).tolist() == labelList == [0, 0, 1, 0]
+    assert np.array_equal(
+        dataset_io.unpackPlanes(dataset_io.loadPacked(array_paths[2]), np.uint8),
+        np.stack(attacksList),
+    )
+
+
+def test_gameStore_windows_match_writeArrays(tmp_path, array_paths):
+    moves = randomGames(8, range(20, 60), random.Random(7), unreplayable=[1])
+    moves[6] = None  # could not be encoded by preprocess
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [k % 2 for k in range(8)]})
+    assert mtf.writeGameStore(df, 45, tmp_path / "store") == 6
+    mtf.writeArrays(df, 5, 30, *array_paths)
+    positions, attacks, indices, labels = dataset_io.loadTrainingData(
+        None, None, None, None, tmp_path / "store", 5, 30
+    )
+    assert indices.shape[1] == 25
+    assert np.array_equal(positions[indices], dataset_io.loadPacked(array_paths[0]))
+    assert np.array_equal(attacks[indices], dataset_io.loadPacked(array_paths[2]))
+    assert np.array_equal(labels, dataset_io.loadLabels(array_paths[1]))
+
+    store = dataset_io.GameStore(tmp_path / "store")
+    kept = [game for k, game in enumerate(moves) if k not in (1, 6)]
+    assert store.lengths.tolist() == [min(len(moves), 45) for moves in kept]
+    indices, labels = store.window(last_plies=15)
+    expected = [
+        mtf.encodeGame(moves, min(len(moves), 45) - 15, 45)
+        for moves in kept
+        if len(moves) >= 15
+    ]
+    assert len(indices) == len(expected) == len(labels)
+    for sample, (positions, _) in zip(indices, expected):
+        assert np.array_equal(store.positions[sample], dataset_io.packPlanes(positions))
+
+
+def test_writeShards_rewrites_changed_shards_only(tmp_path, array_paths):
+    moves = randomGames(7, 40, random.Random(5), unreplayable=[1])
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [0, 1, 0, 1, 1, 0, 1]})
+    dataset = mtf.writeShards(df, 5, 30, tmp_path, shard_size=3)
+    assert [shard["count"] for shard in dataset.shards] == [2, 3, 1]
+    positions, attacks, labels = dataset_io.ShardedDataset(tmp_path).load()
+    mtf.writeArrays(df, 5, 30, *array_paths)
+    assert np.array_equal(positions, dataset_io.loadPacked(array_paths[0]))
+    assert np.array_equal(labels, dataset_io.loadLabels(array_paths[1]))
+    assert np.array_equal(attacks, dataset_io.loadPacked(array_paths[2]))
+
+    mtimes = [(tmp_path / shard["file"]).stat().st_mtime_ns for shard in dataset.shards]
+    df.loc[4, "opponentIsComp"] = 0
+    dataset = mtf.writeShards(df, 5, 30, tmp_path, shard_size=3, workers=2)
+    new_mtimes = [
+        (tmp_path / shard["file"]).stat().st_mtime_ns for shard in dataset.shards
+    ]
+    assert new_mtimes[0] == mtimes[0] and new_mtimes[2] == mtimes[2]
+    assert new_mtimes[1] != mtimes[1]
+    assert dataset_io.ShardedDataset(tmp_path).readShard(1)[2].tolist() == [1, 0, 0]
+
+
+def test_writeShards_keeps_finished_shards_of_interrupted_run(tmp_path, monkeypatch):
+    moves = randomGames(7, 40, random.Random(9))
+    moves[2] = None  # could not be encoded by preprocess
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [0, 1, 0, 1, 1, 0, 1]})
+    encodeShard = mtf.encodeShard
+
+    def crashingEncodeShard(args):
+        if args[0] == 1:
+            raise KeyboardInterrupt()
+        return encodeShard(args)
+
+    monkeypatch.setattr(mtf, "encodeShard", crashingEncodeShard)
+    with pytest.raises(KeyboardInterrupt):
+        mtf.writeShards(df, 5, 30, tmp_path, shard_size=3)
+    dataset = dataset_io.ShardedDataset(tmp_path)
+    assert dataset.shards[0]["count"] == 2
+    assert not dataset.manifest["complete"]
+    with pytest.raises(ValueError):
+        dataset.load()
+    mtime = (tmp_path / dataset.shards[0]["file"]).stat().st_mtime_ns
+
+    monkeypatch.setattr(mtf, "encodeShard", encodeShard)
+    dataset = mtf.writeShards(df, 5, 30, tmp_path, shard_size=3)
+    assert (tmp_path / dataset.shards[0]["file"]).stat().st_mtime_ns == mtime
+    assert [shard["count"] for shard in dataset.shards] == [2, 3, 1]
+    assert len(dataset.load()[2]) == 6
+
+    # a changed file of the same size is only noticed with verify
+    path = tmp_path / dataset.shards[0]["file"]
+    data = bytearray(path.read_bytes())
+    data[-30] ^= 1
+    path.write_bytes(bytes(data))
+    key = dataset.shards[0]["key"]
+    assert dataset.isCurrent(0, key)
+    assert not dataset.isCurrent(0, key, verify=True)
+    path.write_bytes(bytes(data[:-1]))
+    assert not dataset.isCurrent(0, key)
+
+
+def test_AttackTracker_matches_full_recomputation():
+    rng = random.Random(6)
+    plies = 0
+    for _ in range(60):
+        board = chess.Board()
+        tracker = mtf.AttackTracker()
+        assert tracker.update(board) == mtf.getAttackBitboards(board)
+        # long random games, to get captures, promotions, castling and en passant
+        while not board.is_game_over() and len(board.move_stack) < 300:
+            board.push(rng.choice(list(board.legal_moves)))
+            assert tracker.update(board) == mtf.getAttackBitboards(board)
+            plies += 1
+    assert plies > 5000
+
+
+def test_incremental_attacks_match_default_encoding():
+    rng = random.Random(7)
+    games = [randomGameMoves(60, rng) for _ in range(20)]
+    games.append(games[0][:55])  # shares its moves with games[0] in encodeGames
+    for moves in games:
+        expected = mtf.encodeGame(moves, 5, 50)
+        res = mtf.encodeGame(moves, 5, 50, incremental_attacks=True)
+        assert all(np.array_equal(a, b) for a, b in zip(expected, res))
+    expected = mtf.encodeGames(games, 5, 50)
+    for a, b in zip(expected, mtf.encodeGames(games, 5, 50, incremental_attacks=True)):
+        assert np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1])
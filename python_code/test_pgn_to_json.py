@@ -0,0 +1,221 @@
+import bz2
+import gzip
+import json
+import pathlib
+
+import zstandard
+
+import pgn_to_json as ptj
+import preprocess
+from header_filter import headersPassPrefilter
+
+PGN = """[Event "FICS rated standard game"]
+[White "alice"]
+[Black "bob"]
+[Result "0-1"]
+[WhiteIsComp "Yes"]
+[TimeControl "900+0"]
+[PlyCount "4"]
+
+1. e4 e5 2. Nf3 Nc6 0-1
+
+[Event "FICS rated standard game"]
+[White "carol"]
+[Black "dave"]
+[Result "1-0"]
+[TimeControl "300+0"]
+[PlyCount "5"]
+
+1. d4 d5 2. c4 e6 3. Nc3 1-0
+
+"""
+
+
+def writePgn(tmp_path, name="games.pgn", text=PGN):
+    path = pathlib.Path(tmp_path) / name
+    path.write_text(text)
+    return path
+
+
+def test_convert_file_jsonl(tmp_path):
+    pgn_path = writePgn(tmp_path)
+    ptj.convert_file(pgn_path, 100, pathlib.Path(tmp_path), jsonl=True)
+    lines = (pathlib.Path(tmp_path) / "games.jsonl").read_text().splitlines()
+    games = [json.loads(line) for line in lines]
+    assert [game["moves"] for game in games] == [
+        ["e4", "e5", "Nf3", "Nc6"],
+        ["d4", "d5", "c4", "e6", "Nc3"],
+    ]
+    assert games[0]["WhiteIsComp"] == "Yes"
+
+
+def test_readGames_json_and_jsonl_agree(tmp_path):
+    pgn_path = writePgn(tmp_path)
+    ptj.convert_file(pgn_path, 100, pathlib.Path(tmp_path), jsonl=False)
+    ptj.convert_file(pgn_path, 100, pathlib.Path(tmp_path), jsonl=True)
+    df_json = preprocess.readGames(str(pathlib.Path(tmp_path) / "games.json"))
+    df_jsonl = preprocess.readGames(str(pathlib.Path(tmp_path) / "games.jsonl"))
+    assert df_json["moves"].tolist() == df_jsonl["moves"].tolist()
+    assert df_json["White"].tolist() == df_jsonl["White"].tolist() == ["alice", "carol"]
+
+
+def test_iter_games_parallel_matches_serial(tmp_path):
+    pgn_path = writePgn(tmp_path, text=PGN * 7)
+    serial = list(ptj.iter_games(pgn_path, 100, "utf-8-sig"))
+    parallel = list(
+        ptj.iter_games(pgn_path, 100, "utf-8-sig", workers=2, games_per_chunk=3)
+    )
+    assert len(serial) == 14
+    assert parallel == serial
+
+    # max_games keeps its meaning: get_data reads max_games + 1 games
+    limited = list(
+        ptj.iter_games(pgn_path, 4, "utf-8-sig", workers=2, games_per_chunk=2)
+    )
+    assert limited == serial[:5]
+
+
+def test_get_moves_uci(tmp_path):
+    pgn_path = writePgn(tmp_path)
+    games = list(ptj.iter_games(pgn_path, 100, "utf-8-sig", uci=True))
+    assert games[0]["moves"] == ["e2e4", "e7e5", "g1f3", "b8c6"]
+
+
+def test_header_filter_skips_games(tmp_path):
+    pgn_path = writePgn(tmp_path)
+    params = {"plymax": 2, "max_game_length": 100, "timecontrols": ["900+0", "300+0"]}
+
+    def parse(human_color):
+        header_filter = lambda headers: headersPassPrefilter(
+            headers, params, human_color
+        )
+        games = ptj.iter_games(pgn_path, 100, "utf-8-sig", header_filter=header_filter)
+        return [game["White"] for game in games]
+
+    # first game: the engine playing white lost, second game: human black lost
+    assert parse(None) == ["carol"]
+    assert parse("Black") == ["carol"]
+    assert parse("White") == []
+
+
+def test_compressed_input_matches_plain(tmp_path):
+    plain = list(ptj.iter_games(writePgn(tmp_path), 100, "utf-8-sig"))
+    for name, compress in [
+        ("games.pgn.bz2", bz2.compress),
+        ("games.pgn.gz", gzip.compress),
+        ("games.pgn.zst", zstandard.ZstdCompressor().compress),
+    ]:
+        path = pathlib.Path(tmp_path) / name
+        path.write_bytes(compress(PGN.encode()))
+        assert ptj.get_file_list(pathlib.Path(tmp_path)).count(str(path)) == 1
+        assert ptj.pgn_stem(path) == "games"
+        assert list(ptj.iter_games(path, 100, "utf-8-sig", workers=2)) == plain
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_join_resumes_after_interruption_and_only_converts_new_files(tmp_path):
+    inp_dir = pathlib.Path(tmp_path) / "pgn"
+    out_dir = pathlib.Path(tmp_path) / "json"
+    inp_dir.mkdir()
+    out_dir.mkdir()
+    writePgn(inp_dir, "a.pgn", PGN * 5)
+    options = {"mode": "join"}
+    calls = []
+
+    def crashingFilter(headers):
+        calls.append(1)
+        if len(calls) > 7:
+            raise Interrupted()
+        return True
+
+    manifest = ptj.IngestManifest(out_dir, options)
+    try:
+        ptj.create_join_file(
+            ptj.get_file_list(inp_dir),
+            100,
+            out_dir,
+            manifest=manifest,
+            games_per_chunk=3,
+            header_filter=crashingFilter,
+        )
+    except Interrupted:
+        pass
+    checkpoint = manifest.outputs["join_data.json"]["checkpoint"]
+    assert checkpoint["progress"]["games"] == 6
+
+    manifest = ptj.IngestManifest(out_dir, options)
+    ptj.create_join_file(
+        ptj.get_file_list(inp_dir), 100, out_dir, workers=2, manifest=manifest
+    )
+    assert len(json.loads((out_dir / "join_data.json").read_text())) == 10
+
+    writePgn(inp_dir, "b.pgn", PGN)
+    calls.clear()
+    manifest = ptj.IngestManifest(out_dir, options)
+    ptj.create_join_file(
+        ptj.get_file_list(inp_dir),
+        100,
+        out_dir,
+        manifest=manifest,
+        header_filter=crashingFilter,
+    )
+    assert len(calls) == 2  # only the games of the new file were parsed
+    games = json.loads((out_dir / "join_data.json").read_text())
+    assert len(games) == 12
+    assert games == list(ptj.iter_games(inp_dir / "a.pgn", 100, "ISO-8859-1")) + list(
+        ptj.iter_games(inp_dir / "b.pgn", 100, "ISO-8859-1")
+    )
+
+
+def interruptAndResume(tmp_path, file_name, data, workers):
+    """convert a pgn file, interrupted after two chunks, and resume it with workers"""
+    inp_dir = pathlib.Path(tmp_path) / "pgn"
+    out_dir = pathlib.Path(tmp_path) / "json"
+    inp_dir.mkdir()
+    out_dir.mkdir()
+    (inp_dir / file_name).write_bytes(data)
+    calls = []
+
+    def crashingFilter(headers):
+        calls.append(1)
+        if len(calls) > 7:
+            raise Interrupted()
+        return True
+
+    manifest = ptj.IngestManifest(out_dir, {"mode": "join"})
+    try:
+        ptj.create_join_file(
+            ptj.get_file_list(inp_dir),
+            100,
+            out_dir,
+            manifest=manifest,
+            games_per_chunk=3,
+            header_filter=crashingFilter,
+        )
+    except Interrupted:
+        pass
+    assert manifest.outputs["join_data.json"]["checkpoint"]["progress"]["games"] == 6
+    manifest = ptj.IngestManifest(out_dir, {"mode": "join"})
+    ptj.create_join_file(
+        ptj.get_file_list(inp_dir), 100, out_dir, workers=workers, manifest=manifest
+    )
+    return json.loads((out_dir / "join_data.json").read_text())
+
+
+def test_join_resumes_serially(tmp_path):
+    games = interruptAndResume(tmp_path, "a.pgn", (PGN * 5).encode(), workers=1)
+    assert len(games) == 10
+    assert games == list(ptj.iter_games(tmp_path / "pgn" / "a.pgn", 100, "ISO-8859-1"))
+
+
+def test_join_resumes_compressed_file(tmp_path):
+    games = interruptAndResume(
+        tmp_path, "a.pgn.bz2", bz2.compress((PGN * 5).encode()), workers=2
+    )
+    assert len(games) == 10
+    assert games == list(
+        ptj.iter_games(tmp_path / "pgn" / "a.pgn.bz2", 100, "ISO-8859-1")
+    )
@@ -0,0 +1,100 @@
+import random
+
+import chess
+import chess.polyglot
+import numpy as np
+import pandas as pd
+
+import moves_to_fen as mtf
+import position_cache
+from random_games import randomGameMoves, randomGames
+
+
+def test_zobristHash_matches_polyglot():
+    hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+    board = chess.Board()
+    key = position_cache.zobristHash(mtf.getBitboards(board))
+    assert key == hasher.hash_board(board)
+    for move in randomGameMoves(80, random.Random(0)):
+        bitboards = mtf.getBitboards(board)
+        board.push_san(move)
+        key = position_cache.updateZobristHash(key, bitboards, mtf.getBitboards(board))
+        assert key == hasher.hash_board(board)
+
+
+def test_encodeGame_with_cache(tmp_path):
+    rng = random.Random(1)
+    opening = randomGameMoves(20, rng)
+    games = []
+    for _ in range(5):
+        board = chess.Board()
+        for move in opening:
+            board.push_san(move)
+        moves = list(opening)
+        while len(moves) < 50 and not board.is_game_over():
+            move = rng.choice(list(board.legal_moves))
+            moves.append(board.san(move))
+            board.push(move)
+        games.append(moves)
+    cache = position_cache.PositionCache(max_size=1000, path=tmp_path / "cache.db")
+    for moves in games:
+        expected = mtf.encodeGame(moves, 5, 40)
+        res = mtf.encodeGame(moves, 5, 40, cache)
+        assert all(np.array_equal(a, b) for a, b in zip(expected, res))
+    stats = cache.stats()
+    assert stats["hits"] >= 4 * 15  # the plies 5 to 20 of the shared opening
+    cache.close()
+
+    # a new process finds the positions in the on-disk tier
+    cache = position_cache.PositionCache(max_size=10, path=tmp_path / "cache.db")
+    res = mtf.encodeGame(games[0], 5, 40, cache)
+    assert all(np.array_equal(a, b) for a, b in zip(mtf.encodeGame(games[0], 5, 40), res))
+    assert cache.stats()["disk_hits"] > 0
+    assert len(cache.entries) == 10
+    cache.close()
+
+
+def test_writeArrays_encodes_only_new_games(tmp_path, array_paths):
+    # the game that fails to replay is cached as such
+    moves = randomGames(8, 40, random.Random(2), unreplayable=[2])
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [k % 2 for k in range(8)]})
+    cache_options = {"game_path": str(tmp_path / "games.db")}
+    mtf.writeArrays(df.iloc[:5], 5, 30, *array_paths, cache_options=cache_options)
+    gameCache = position_cache.getGameCache(cache_options["game_path"])
+    assert gameCache.stats()["misses"] == 5
+
+    # a rebuild with three more games only encodes those
+    assert mtf.writeArrays(df, 5, 30, *array_paths, cache_options=cache_options) == 7
+    assert gameCache.stats()["misses"] == 8
+    assert gameCache.stats()["hits"] == 5
+    expected = [
+        tmp_path / name for name in ("e_fen.npy", "e_labels.npy", "e_attacks.npy")
+    ]
+    mtf.writeArrays(df, 5, 30, *expected)
+    for path, expectedPath in zip(array_paths, expected):
+        assert np.array_equal(np.load(path), np.load(expectedPath))
+
+    # other plies are other keys
+    mtf.writeArrays(df, 10, 30, *array_paths, cache_options=cache_options)
+    assert gameCache.stats()["misses"] == 16
+
+
+def test_parallel_workers_share_cache_files_and_report_stats(
+    tmp_path, array_paths, caplog
+):
+    moves = randomGames(12, 40, random.Random(3))
+    df = pd.DataFrame({"moves": moves, "opponentIsComp": [k % 2 for k in range(12)]})
+    cache_options = {
+        "max_size": 1000,
+        "path": str(tmp_path / "positions.db"),
+        "game_path": str(tmp_path / "games.db"),
+    }
+    for _ in range(2):
+        caplog.clear()
+        with caplog.at_level("INFO"):
+            mtf.writeArrays(df, 5, 30, *array_paths, 3, 2, cache_options)
+    # the lookups of all workers are added up, the second run finds every game
+    assert "game cache: {'hits': 12}" in caplog.text
+    gameCache = position_cache.GameCache(cache_options["game_path"])
+    assert all(gameCache.get(mtf.gameKey(m, 5, 30)) is not None for m in moves)
+    gameCache.close()
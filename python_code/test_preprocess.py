@@ -0,0 +1,125 @@
+import chess
+import numpy as np
+import pandas as pd
+import pyarrow.parquet
+
+import moves_to_fen as mtf
+import preprocess
+from move_encoding import decodeMoves
+
+PARAMS = {"plymax": 4, "max_game_length": 100, "timecontrols": ["900+0"]}
+
+
+def makeGames(n_games, seed=0):
+    """n_games games with all header columns pgn_to_json writes, a mix of results,
+    engine flags and game lengths"""
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame(
+        {
+            "Event": "FICS rated standard game",
+            "White": ["white_%d" % i for i in range(n_games)],
+            "Black": ["black_%d" % i for i in range(n_games)],
+            "Result": rng.choice(["1-0", "0-1", "1/2-1/2"], n_games),
+            "WhiteIsComp": rng.choice([None, "Yes"], n_games),
+            "BlackIsComp": rng.choice([None, "Yes"], n_games),
+            "TimeControl": rng.choice(["900+0", "60+0"], n_games, p=[0.8, 0.2]),
+            "PlyCount": rng.randint(2, 12, n_games),
+            "moves": [["e4", "e5", "Nf3"][: 1 + i % 3] for i in range(n_games)],
+        }
+    )
+
+
+def test_loadData_reads_needed_columns_of_all_formats(tmp_path):
+    df = makeGames(30)
+    paths = [tmp_path / "a.json", tmp_path / "b.jsonl", tmp_path / "c.parquet"]
+    df[:10].to_json(paths[0], orient="records")
+    df[10:20].to_json(paths[1], orient="records", lines=True)
+    df[20:].to_parquet(paths[2])
+
+    loaded = preprocess.loadData([str(path) for path in paths], workers=2)
+    assert list(loaded.columns) == preprocess.PREPROCESS_COLUMNS
+    assert loaded["moves"].map(list).tolist() == df["moves"].tolist()
+    assert loaded["PlyCount"].tolist() == df["PlyCount"].tolist()
+    assert loaded["WhiteIsComp"].isnull().tolist() == df["WhiteIsComp"].isnull().tolist()
+
+
+def sortedGames(df):
+    return sorted(zip(df.opponentIsComp, df.moves.map(tuple)))
+
+
+def test_preprocessChunked_matches_in_memory(tmp_path):
+    df = makeGames(500)
+    df.to_json(tmp_path / "games.jsonl", orient="records", lines=True)
+    files = [str(tmp_path / "games.jsonl")]
+
+    output_paths = {
+        color: str(tmp_path / (color + ".parquet")) for color in ["White", "Black"]
+    }
+
+    n_games = preprocess.preprocessChunked(files, PARAMS, output_paths, 37)
+    for color, output_path in output_paths.items():
+        chunked = pd.read_parquet(output_path)
+        in_memory = preprocess.prefilterGames(preprocess.loadData(files), PARAMS, color)
+        assert n_games[color] == len(chunked) == len(in_memory) > 0
+        assert sortedGames(chunked) == sortedGames(in_memory)
+        assert (chunked.opponentIsComp == 1.0).sum() == len(chunked) // 2
+
+
+def test_duplicates_across_files_are_dropped(tmp_path):
+    df = makeGames(300).assign(Date="2019.01.01", Time="12:00:00")
+    reposted = df[::3].assign(Event="FICS rated blitz game")  # same games, new event
+    reposted = reposted.assign(White=reposted.White.str.upper() + " ")
+    other = df[1::3].assign(Time="12:00:01")  # other games of the same players
+    paths = [tmp_path / "2018.jsonl", tmp_path / "2019.parquet"]
+    df.to_json(paths[0], orient="records", lines=True)
+    pd.concat([reposted, other]).to_parquet(paths[1])
+    files = [str(path) for path in paths]
+
+    deduplicator = preprocess.GameDeduplicator()
+    shared = preprocess.filterSharedCriteria(preprocess.loadData(files), PARAMS)
+    in_memory = deduplicator.filter(shared)
+    assert deduplicator.games == len(shared)
+    assert deduplicator.duplicates == len(shared) - len(in_memory) > 0
+    expected = preprocess.filterSharedCriteria(
+        pd.concat([df, other], ignore_index=True), PARAMS
+    )
+    assert len(in_memory) == len(expected)
+
+    output_paths = {"White": str(tmp_path / "white.parquet")}
+    n_games = preprocess.preprocessChunked(files, PARAMS, output_paths, 41)
+    chunked = pd.read_parquet(output_paths["White"])
+    counts = preprocess.selectHumanColor(in_memory, "White").opponentIsComp
+    assert n_games["White"] == len(chunked) == 2 * counts.value_counts().min()
+
+
+def test_deduplicator_chunk_by_chunk_matches_whole_frame():
+    df = makeGames(400).assign(Date="2019.01.01", Time="12:00:00")
+    df = pd.concat([df, df.sample(300, random_state=0)], ignore_index=True)
+    whole = preprocess.GameDeduplicator()
+    expected = whole.filter(df)
+    chunked = preprocess.GameDeduplicator()
+    kept = pd.concat([chunked.filter(df[i : i + 7]) for i in range(0, len(df), 7)])
+    assert kept.index.tolist() == expected.index.tolist() == list(range(400))
+    assert chunked.duplicates == whole.duplicates == 300
+    assert len(chunked) == 400
+    assert len(chunked.runs) <= 8  # merged as they grow, O(log n) runs
+
+
+def test_encoded_moves_roundtrip(tmp_path):
+    df = pd.DataFrame(
+        {
+            "opponentIsComp": [1.0, 0.0],
+            "moves": [["e4", "e5", "Nf3", "Nc6", "Bb5"], ["d4", "Ke7"]],  # 2nd illegal
+        }
+    )
+    path = str(tmp_path / "games.parquet")
+    preprocess.writeOutput(df, path, encode_moves=True)
+
+    schema = pyarrow.parquet.read_schema(path)
+    assert str(schema.field("moves_encoded").type) == "list<element: int16>"
+    games = mtf.loadGames(path)
+    assert games["moves"][0].dtype == np.int16
+    assert games["moves"][1] is None
+    board = chess.Board()
+    moves = [board.san_and_push(move) for move in decodeMoves(games["moves"][0])]
+    assert moves == df.moves[0]
@@ -22,6 +22,9 @@ from tensorflow.keras.layers import (
 from tensorflow.keras.optimizers import SGD, Adam
 from tensorflow.keras.regularizers import l2
 
+from dataset_io import loadTrainingData
+from packed_sequence import PackedSequence
+
 logging.basicConfig(level=logging.INFO,)
 
 LOGGER = logging.getLogger()
@@ -64,45 +67,79 @@ def buildModel(
     return myModel
 
 
-def trainModel(model, X_train, y_train, X_test, y_test):
+def trainModel(model, train_batches, test_batches):
     # early_stopping = EarlyStopping(monitor="val_loss", patience=3)
     # early_stopping = EarlyStopping(monitor="loss", patience=3)
 
     hist = model.fit(
-        X_train,
-        y_train,
-        batch_size=128,
+        train_batches,
         epochs=20,
-        validation_data=(X_test, y_test),
+        validation_data=test_batches,
         # callbacks=[early_stopping,],
     )
 
 
 @click.command()
 @click.option(
-    "--input-path", help="input array of training data (piece positions)", required=True
+    "--input-path", help="input array of training data (piece positions)",
 )
 @click.option(
     "--input-path-attacks",
     help="input array of training data (attacked squares)",
-    required=True,
 )
-@click.option("--input-path-labels", help="input array of labels", required=True)
+@click.option("--input-path-labels", help="input array of labels")
+@click.option(
+    "--input-dir", help="sharded data set, instead of the three input arrays",
+)
+@click.option(
+    "--store-dir", help="game store with every ply, instead of a data set of windows",
+)
+@click.option("--min-ply", default=0, help="first ply of the window of a game store")
+@click.option("--max-ply", type=int, help="end of the ply window of a game store")
+@click.option(
+    "--last-plies",
+    type=int,
+    help="train on the last plies of the games of a game store instead of a window",
+)
 @click.option("--output-path", help="where to save the model", required=True)
-def main(input_path, input_path_labels, input_path_attacks, output_path):
+def main(
+    input_path,
+    input_path_labels,
+    input_path_attacks,
+    input_dir,
+    store_dir,
+    min_ply,
+    max_ply,
+    last_plies,
+    output_path,
+):
     # data dims: (samples, time, channel, row, col)
-    data_positions = np.load(input_path)["arr_0"]
-    data_attacks = np.load(input_path_attacks)["arr_0"]
-    data = np.concatenate((data_positions, data_attacks), axis=2)
-    num_channels = data.shape[2]
-    data = data.reshape(data.shape[0], data.shape[1], -1)
-    labels = np.load(input_path_labels)["arr_0"]
-    LOGGER.info(f"Training Conv3D model on data of shape {data.shape}")
-
-    model = buildModel(num_input_channels=num_channels, num_timesteps=data.shape[1])
-
-    X_train, X_test, y_train, y_test = scaleAndSplit(data, labels)
-    trainModel(model, X_train, y_train, X_test, y_test)
+    # positions and attacks stay bit packed, batches are unpacked by PackedSequence
+    positions, attacks, indices, labels = loadTrainingData(
+        input_path,
+        input_path_attacks,
+        input_path_labels,
+        input_dir,
+        store_dir,
+        min_ply,
+        max_ply,
+        last_plies,
+    )
+    num_channels = positions.shape[-2] + attacks.shape[-2]
+    num_timesteps = positions[indices[:1]].shape[1]
+    LOGGER.info(
+        f"Training Conv3D model on data of shape "
+        f"{(len(labels), num_timesteps, num_channels, 8, 8)}"
+    )
+
+    model = buildModel(num_input_channels=num_channels, num_timesteps=num_timesteps)
+
+    idx_train, idx_test, y_train, y_test = scaleAndSplit(indices, labels)
+    train_batches = PackedSequence(
+        positions, attacks, idx_train, y_train, flatten=True, shuffle=True
+    )
+    test_batches = PackedSequence(positions, attacks, idx_test, y_test, flatten=True)
+    trainModel(model, train_batches, test_batches)
     model.save(output_path)
 
 